@@ -1,6 +1,7 @@
 import pandas as pd
 import argparse
-import gzip
+
+from scripts.gene_index import load_gene_index
 
 # Set up argument parser
 parser = argparse.ArgumentParser(description='Filter genes based on baseMean threshold')
@@ -44,7 +45,6 @@ GTF_PATH = 'data/gencode.vM10.basic.annotation.gtf.gz'
 
 # Read the GTF file to get all genes from mm10 genome
 def get_all_genes_from_gtf(gtf_path):
-    genes = set()
     # Define valid gene types
     valid_gene_types = {
         'protein_coding'
@@ -53,30 +53,10 @@ def get_all_genes_from_gtf(gtf_path):
         # 'snRNA', 'rRNA'
     }
     
-    with gzip.open(gtf_path, 'rt') as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            fields = line.strip().split('\t')
-            if fields[2] == 'gene':
-                # More robust attribute parsing
-                attr_dict = {}
-                for attr in fields[8].split(';'):
-                    if not attr.strip():
-                        continue
-                    try:
-                        key, value = attr.strip().split(' "', 1)
-                        attr_dict[key.strip()] = value.strip('"')
-                    except ValueError:
-                        continue
-                
-                # Check if it's a valid gene type
-                gene_type = attr_dict.get('gene_type', '')
-                gene_name = attr_dict.get('gene_name', '')
-                
-                if gene_type in valid_gene_types and gene_name:
-                    genes.add(gene_name)
-    return genes
+    # Gene records come from the cached GTF index (parsed once per GTF version)
+    gene_index = load_gene_index(gtf_path)
+    valid = gene_index['gene_type'].isin(valid_gene_types) & (gene_index['gene_name'] != '')
+    return set(gene_index.loc[valid, 'gene_name'])
 
 # Read the files
 dea = pd.read_csv(f'{DEA_PATH}/DEA_NSC.csv')
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+#' Render all SMARCB1 TSS heatmaps and metaprofiles in one process
+#'
+#' Input files:
+#' - results/bigwig/BG{1,2,3}_CPM.bw: Control replicate bigWig files
+#' - results/bigwig/BM3_CPM.bw: SMARCB1 ChIP-seq bigWig file
+#' - data/gencode.vM10.annotation.gtf.gz: Gene annotations
+#' - Gene_lists/targets/all_targets_final.csv: Targeted genes
+#' - Gene_lists/targets/all_no_targets_mm10.csv: Non-targeted genes
+#' - Gene_lists/targets/all_targets_final_{up,down,not}_regulated.csv: Regulated gene categories
+#'
+#' Output files (results/metaprofiles_comparison_R/):
+#' - targeted_nontargeted_heatmaps.pdf: BM heatmaps, 99th percentile scale
+#' - targeted_nontargeted_heatmaps_bg.pdf / _bm.pdf: BG and BM heatmaps, fixed scale
+#' - regulated_genes_heatmaps_bm.pdf: BM heatmaps of regulated gene categories
+#' - combined_regulated_genes_profile.pdf: BG and BM metaprofiles with log2 fold change
+#' - regulated_genes_BM_profile.pdf: BM metaprofiles of regulated gene categories
+#'
+#' Usage:
+#'   python plot_tss_figures.py                                  # all figures
+#'   python plot_tss_figures.py --figures regulated_heatmaps_bm regulated_profiles
+#'
+#' The signal for the union of all gene lists used by the selected figures is
+#' extracted (or loaded from the cache) once and shared by every figure. The
+#' figures are then drawn in parallel, one per worker process.
+
+import argparse
+import os
+import warnings
+
+from signal_plots import render_figures
+
+# Suppress warnings
+warnings.filterwarnings('ignore')
+
+OUTPUT_DIR = "results/metaprofiles_comparison_R"
+
+SAMPLE_GROUPS = {
+    'bg': [
+        "results/bigwig/BG1_CPM.bw",
+        "results/bigwig/BG2_CPM.bw",
+        "results/bigwig/BG3_CPM.bw"
+    ],
+    'bm': ["results/bigwig/BM3_CPM.bw"]
+}
+
+GTF_FILE = "data/gencode.vM10.annotation.gtf.gz"
+
+GENE_FILES = {
+    'targeted': "Gene_lists/targets/all_targets_final.csv",
+    'nontargeted': "Gene_lists/targets/all_no_targets_mm10.csv",
+    'up': "Gene_lists/targets/all_targets_final_up_regulated.csv",
+    'down': "Gene_lists/targets/all_targets_final_down_regulated.csv",
+    'not': "Gene_lists/targets/all_targets_final_not_regulated.csv"
+}
+
+TARGETED_PANELS = [('targeted', 'Targeted Genes'), ('nontargeted', 'Non-targeted Genes')]
+REGULATED_PANELS = [('up', 'Up-regulated Genes'), ('down', 'Down-regulated Genes'),
+                    ('not', 'Non-regulated Genes')]
+
+FIGURES = {
+    'targeted_heatmaps': {
+        'kind': 'heatmap',
+        'output': f"{OUTPUT_DIR}/targeted_nontargeted_heatmaps.pdf",
+        'title': 'SMARCB1 Signal at TSS',
+        'scale': ('percentile', 99),
+        'panels': [{'gene_set': s, 'group': 'bm', 'title': t} for s, t in TARGETED_PANELS]
+    },
+    'targeted_heatmaps_bg': {
+        'kind': 'heatmap',
+        'output': f"{OUTPUT_DIR}/targeted_nontargeted_heatmaps_bg.pdf",
+        'title': 'SMARCB1 Signal at TSS',
+        'scale': 18.0,
+        'panels': [{'gene_set': s, 'group': 'bg', 'title': t} for s, t in TARGETED_PANELS]
+    },
+    'targeted_heatmaps_bm': {
+        'kind': 'heatmap',
+        'output': f"{OUTPUT_DIR}/targeted_nontargeted_heatmaps_bm.pdf",
+        'title': 'SMARCB1 Signal at TSS',
+        'scale': 18.0,
+        'panels': [{'gene_set': s, 'group': 'bm', 'title': t} for s, t in TARGETED_PANELS]
+    },
+    'regulated_heatmaps_bm': {
+        'kind': 'heatmap',
+        'output': f"{OUTPUT_DIR}/regulated_genes_heatmaps_bm.pdf",
+        'title': 'SMARCB1 Signal at TSS of Regulated Genes',
+        'scale': 18.0,
+        'show_n': True,
+        'panels': [{'gene_set': s, 'group': 'bm', 'title': t} for s, t in REGULATED_PANELS]
+    },
+    'regulated_profiles': {
+        'kind': 'profile',
+        'output': f"{OUTPUT_DIR}/combined_regulated_genes_profile.pdf",
+        'title': 'SMARCB1 binding around TSS',
+        'lines': [line for s in ['up', 'down', 'not'] for line in [
+            {'gene_set': s, 'group': 'bg', 'label': f'{s.capitalize()} regulated - BG',
+             'linestyle': '--', 'alpha': 0.1},
+            {'gene_set': s, 'group': 'bm', 'label': f'{s.capitalize()} regulated - BM',
+             'linestyle': '-', 'alpha': 0.2}]],
+        'fold_change': {'numerator': 'bm', 'denominator': 'bg'}
+    },
+    'regulated_profiles_bm': {
+        'kind': 'profile',
+        'output': f"{OUTPUT_DIR}/regulated_genes_BM_profile.pdf",
+        'title': 'SMARCB1 binding around TSS',
+        'lines': [{'gene_set': s, 'group': 'bm', 'label': f'{s.capitalize()} regulated'}
+                  for s in ['up', 'down', 'not']]
+    }
+}
+
+
+def run(figure_names, processes=None):
+    """Render the named figures from one shared signal load."""
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    render_figures([FIGURES[name] for name in figure_names], SAMPLE_GROUPS, GENE_FILES, GTF_FILE,
+                   processes=processes)
+    print("Analysis completed successfully!")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render SMARCB1 TSS heatmaps and metaprofiles')
+    parser.add_argument('--figures', nargs='+', choices=list(FIGURES), default=list(FIGURES),
+                        help='Figures to render (default: all)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Figures drawn in parallel (default: SLURM allocation or available CPUs)')
+    args = parser.parse_args()
+    run(args.figures, args.processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+#!/bin/bash
+#SBATCH --job-name=plot_tss_figures
+#SBATCH --account=kubacki.michal
+#SBATCH --mem=64GB
+#SBATCH --time=12:00:00
+#SBATCH --nodes=1
+#SBATCH --ntasks=16
+#SBATCH --error="logs/plot_tss_figures_Py.err"
+#SBATCH --output="logs/plot_tss_figures_Py.out"
+
+# Set working directory
+WORKING_DIR="/beegfs/scratch/ric.broccoli/kubacki.michal/SRF_MeCP2_SMARCB1"
+cd ${WORKING_DIR}
+
+# Activate conda environment
+source /opt/common/tools/ric.cosr/miniconda3/bin/activate
+conda activate snakemake
+
+mkdir -p results/metaprofiles_comparison_R
+
+python plot_tss_figures.py
+
+echo "plot_tss_figures.py completed!" 
\ No newline at end of file
@@ -4,11 +4,13 @@ This script annotates promoter comparison results with gene information and calc
 The script performs the following steps:
 1. Reads promoter comparison data containing read counts and fold changes
 2. Merges this data with gene information from a provided gene list
-3. Calculates absolute log2 fold changes for sorting
-4. Saves the annotated results to a file
-5. Identifies significantly changed promoters (|log2FC| > 1)
-6. Generates summary statistics on up/down-regulated promoters
-7. Saves significant changes to a separate file
+3. Matches regions to overlapping genes through a sorted interval index
+   (optionally falling back to the nearest gene within a given distance)
+4. Calculates absolute log2 fold changes for sorting
+5. Saves the annotated results to a file
+6. Identifies significantly changed promoters (|log2FC| > 1)
+7. Generates summary statistics on up/down-regulated promoters
+8. Saves significant changes to a separate file
 
 Input files:
 - Promoter comparison file with read counts and fold changes
@@ -25,6 +27,9 @@ import logging
 import os
 import numpy as np
 
+from gene_index import load_gene_index
+from interval_index import build_interval_index, overlap_pairs, nearest_intervals
+
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -35,7 +40,7 @@ def read_gene_coordinates(gene_list_file, gtf_file="/beegfs/scratch/ric.broccoli
     
     Args:
         gene_list_file (str): Path to file containing list of gene names to filter for
-        gtf_file (str): Path to GTF annotation file (gzipped)
+        gtf_file (str): Path to GTF annotation file (gzipped or uncompressed)
         
     Returns:
         pandas.DataFrame: DataFrame containing filtered gene coordinates with columns:
@@ -50,32 +55,12 @@ def read_gene_coordinates(gene_list_file, gtf_file="/beegfs/scratch/ric.broccoli
         wanted_genes = set(line.strip() for line in f if line.strip())
     
     logger.info(f"Reading gene coordinates from {gtf_file}")
-    # Read only gene entries from GTF
-    gene_coords = []
-    import gzip
-    with gzip.open(gtf_file, 'rt') as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            fields = line.strip().split('\t')
-            # Only process gene features
-            if fields[2] != 'gene':
-                continue
-            
-            # Parse gene name from GTF attributes field
-            attrs = dict(x.strip().split(' ', 1) for x in fields[8].rstrip(';').split('; '))
-            gene_name = attrs.get('gene_name', '').strip('"')
-            
-            # Only keep genes in our wanted list
-            if gene_name in wanted_genes:
-                gene_coords.append({
-                    'chr': fields[0],
-                    'start': int(fields[3]),
-                    'end': int(fields[4]),
-                    'gene_name': gene_name
-                })
-    
-    gene_coords = pd.DataFrame(gene_coords)
+    # Look up genes in the cached GTF index instead of re-parsing the GTF
+    gene_index = load_gene_index(gtf_file)
+    gene_coords = gene_index.loc[gene_index['gene_name'].isin(wanted_genes),
+                                 ['chrom', 'start', 'end', 'gene_name']]
+    gene_coords = gene_coords.rename(columns={'chrom': 'chr'}).reset_index(drop=True)
+    gene_coords['chr'] = gene_coords['chr'].astype(str)
     
     # Ensure chromosome names are standardized with 'chr' prefix
     gene_coords['chr'] = gene_coords['chr'].apply(
@@ -91,66 +76,62 @@ def read_gene_coordinates(gene_list_file, gtf_file="/beegfs/scratch/ric.broccoli
     
     return gene_coords
 
-def find_overlapping_gene(row, gene_coords):
+def find_overlapping_genes(regions, gene_coords, nearest_distance=None):
     """
-    Find gene that overlaps with the given genomic coordinates.
+    Find the gene overlapping each genomic region, for all regions at once.
+    
+    Regions and genes are matched through a per-chromosome sorted interval index.
+    When several genes overlap a region, the one with the largest overlap wins
+    (ties go to the lexicographically largest gene name). Regions without an
+    overlapping gene can optionally fall back to the nearest gene.
     
     Args:
-        row (pandas.Series): Series containing genomic coordinates with 'chr', 'start', 'end'
-        gene_coords (pandas.DataFrame): DataFrame of gene coordinates to search
+        regions (pandas.DataFrame): Genomic regions with 'chr', 'start', 'end'
+        gene_coords (pandas.DataFrame): Gene coordinates with 'chr', 'start', 'end', 'gene_name'
+        nearest_distance (int): Maximum distance (bp) for the nearest-gene fallback;
+                                None disables the fallback
         
     Returns:
-        str: Name of overlapping gene, or None if no overlap found
+        tuple: (pandas.Series of gene names, None where unmatched;
+                pandas.Series of distances to the assigned gene, 0 for overlaps)
     """
     # Ensure chromosome format matches
-    chr_name = row['chr'] if str(row['chr']).startswith('chr') else f"chr{row['chr']}"
-    
-    # Add debug logging for this region
-    logger.debug(f"\nLooking for overlap with region: {chr_name}:{row['start']}-{row['end']}")
-    
-    # Check if chromosome exists in gene_coords
-    if chr_name not in gene_coords['chr'].values:
-        logger.debug(f"Chromosome {chr_name} not found in gene coordinates")
-        return None
-    
-    # Get genes on this chromosome
-    chr_genes = gene_coords[gene_coords['chr'] == chr_name]
-    logger.debug(f"Found {len(chr_genes)} genes on chromosome {chr_name}")
-    
-    # Find genes that overlap with our region
-    overlapping = chr_genes[
-        (chr_genes['start'] <= row['end']) &
-        (chr_genes['end'] >= row['start'])
-    ]
-    
-    if len(overlapping) == 0:
-        logger.debug(f"No overlapping genes found")
-        # Log nearby genes for debugging
-        nearby = chr_genes[
-            (abs(chr_genes['start'] - row['start']) < 10000) |
-            (abs(chr_genes['end'] - row['end']) < 10000)
-        ]
-        if not nearby.empty:
-            logger.debug("Nearby genes (within 10kb):")
-            logger.debug(nearby[['chr', 'start', 'end', 'gene_name']])
-        return None
-    elif len(overlapping) == 1:
-        gene_name = overlapping.iloc[0]['gene_name']
-        logger.debug(f"Found single overlapping gene: {gene_name}")
-        return gene_name
-    else:
-        # If multiple genes overlap, take the one with the most overlap
-        overlaps = []
-        for _, gene in overlapping.iterrows():
-            overlap_start = max(row['start'], gene['start'])
-            overlap_end = min(row['end'], gene['end'])
-            overlap_length = overlap_end - overlap_start
-            overlaps.append((overlap_length, gene['gene_name']))
-        gene_name = max(overlaps)[1]
-        logger.debug(f"Found multiple overlapping genes ({len(overlapping)}), selected: {gene_name}")
-        return gene_name
+    chroms = regions['chr'].astype(str)
+    query = pd.DataFrame({
+        'chr': chroms.where(chroms.str.startswith('chr'), 'chr' + chroms).to_numpy(),
+        'start': regions['start'].to_numpy(),
+        'end': regions['end'].to_numpy()
+    })
+    gene_names = gene_coords['gene_name'].to_numpy(dtype=object)
+    genes = np.full(len(query), None, dtype=object)
+    distance = np.full(len(query), np.nan)
+    
+    index = build_interval_index(gene_coords, closed=True)
+    query_pos, gene_pos, overlap = overlap_pairs(index, query)
+    
+    if len(query_pos):
+        # Largest overlap wins; sort by (region, overlap, gene name) and keep the last per region
+        order = np.lexsort((gene_names[gene_pos].astype(str), overlap, query_pos))
+        query_pos, gene_pos = query_pos[order], gene_pos[order]
+        last = np.r_[query_pos[1:] != query_pos[:-1], True]
+        genes[query_pos[last]] = gene_names[gene_pos[last]]
+        distance[query_pos[last]] = 0
+        multiple = np.bincount(query_pos, minlength=len(query)) > 1
+        logger.debug(f"{multiple.sum()} regions overlap multiple genes; kept the largest overlap")
+    
+    if nearest_distance is not None:
+        unmatched = np.flatnonzero(pd.isna(genes))
+        nearest, gap = nearest_intervals(index, query.iloc[unmatched], nearest_distance)
+        found = nearest >= 0
+        genes[unmatched[found]] = gene_names[nearest[found]]
+        distance[unmatched[found]] = gap[found]
+        logger.info(f"Assigned {found.sum()} of {len(unmatched)} non-overlapping regions "
+                    f"to the nearest gene within {nearest_distance} bp")
+    
+    return (pd.Series(genes, index=regions.index, dtype=object),
+            pd.Series(distance, index=regions.index))
 
-def annotate_promoters(comparison_file, gene_list_file, output_file, sample_name):
+def annotate_promoters(comparison_file, gene_list_file, output_file, sample_name, nearest_distance=None):
     """
     Annotate the promoter comparison results with gene information.
     
@@ -159,6 +140,8 @@ def annotate_promoters(comparison_file, gene_list_file, output_file, sample_name
         gene_list_file (str): Path to file with gene list
         output_file (str): Path to save annotated results
         sample_name (str): Name of the sample for output files
+        nearest_distance (int): Optional maximum distance (bp) to assign regions
+                                without an overlapping gene to the nearest gene
         
     This function:
     1. Reads promoter comparison results
@@ -203,10 +186,12 @@ def annotate_promoters(comparison_file, gene_list_file, output_file, sample_name
     logger.info("Matching genomic coordinates to genes")
     annotated_df = comp_df.copy()
     
-    # Find overlapping genes for each region
-    annotated_df['gene'] = annotated_df.apply(
-        lambda row: find_overlapping_gene(row, gene_coords), axis=1
+    # Find overlapping genes for all regions at once
+    annotated_df['gene'], gene_distance = find_overlapping_genes(
+        annotated_df, gene_coords, nearest_distance=nearest_distance
     )
+    if nearest_distance is not None:
+        annotated_df['gene_distance'] = gene_distance
     
     # Handle unmatched regions
     unmatched = annotated_df['gene'].isna().sum()
@@ -257,11 +242,15 @@ def main():
                         help='Output annotated file')
     parser.add_argument('--sample-name', required=True,
                         help='Sample name') 
+    parser.add_argument('--nearest-distance', type=int, default=None,
+                        help='Assign regions without an overlapping gene to the nearest '
+                             'gene within this many bp (default: disabled)')
     
     args = parser.parse_args()
     
     try:
-        annotate_promoters(args.input, args.gene_list, args.output, args.sample_name)
+        annotate_promoters(args.input, args.gene_list, args.output, args.sample_name,
+                           nearest_distance=args.nearest_distance)
     except Exception as e:
         logger.error(f"Annotation failed: {str(e)}")
         raise
@@ -4,10 +4,20 @@ It processes normalized read count data from peak regions and calculates fold ch
 applying quality filters and generating summary statistics.
 
 Key features:
-- Reads and validates input count files
+- Reads single-sample count files, count matrices (--bams output) or columnar
+  .npz count matrices from count_reads_in_peaks.py
+- Joins all samples on region coordinates (categorical chromosome, int32
+  start/end) with a sort-merge; regions missing from any file are reported
+  and written to <output>_unmatched.txt instead of being misaligned
 - Calculates mean signal for BG and BM sample groups 
+- Computes many contrasts (a sample sheet plus a contrast list, or every
+  BG x BM sample pair) from one loaded matrix with broadcast array operations
+- Optionally re-normalizes all samples together from raw counts (CPM, RPKM,
+  median-of-ratios or TMM) and records the normalization used
 - Applies minimum count threshold filtering
 - Computes log2 fold changes with pseudocount normalization
+- Tests each region with a moderated Welch t-test (empirical-Bayes variance
+  shrinkage) on log2 counts and adds Benjamini-Hochberg adjusted p-values
 - Generates QC metrics and visualization
 - Outputs detailed comparison statistics
 """
@@ -19,6 +29,10 @@ import os
 import logging
 import matplotlib.pyplot as plt
 
+from count_tables import load_count_tables
+from differential_stats import bh_adjust, moderated_welch_test
+from normalization import NORMALIZATION_METHODS, normalize_counts
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -46,134 +60,386 @@ def validate_input_data(count_files):
         if df.empty or df['count'].isnull().all():
             raise ValueError(f"No valid count data in {file}")
 
-def compare_peaks(peak_count_files, output_file, sample_name, threads=1):
+# Minimum mean count in either group for a region to get a fold change
+MIN_COUNT = 5
+
+# Added to both group means before taking the log2 ratio
+PSEUDOCOUNT = 1.0
+
+def conditions_from_prefix(samples, prefixes=('BG', 'BM')):
     """
-    Compare normalized peak counts between conditions.
-    
+    Group samples into conditions by name prefix.
+
     Args:
-        peak_count_files (list): List of input count files
-        output_file (str): Path to output comparison file
-        sample_name (str): Name identifier for the comparison
-        threads (int): Number of threads to use (default: 1)
+        samples (list): Sample names
+        prefixes (tuple): Condition name prefixes
+
+    Returns:
+        dict: {condition: [samples]}, in sample order
     """
-    
-    # Create output directory if it doesn't exist
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    
-    # Read and process peak counts
-    peak_counts = {}
-    first_df = None
-    
-    # Load count data from each input file
-    for count_file in peak_count_files:
-        sample = os.path.basename(count_file).replace('_promoter_counts.txt', '')
-        logger.info(f"Reading {count_file}...")
-        
-        try:
-            df = pd.read_csv(count_file, sep='\t')
-            # Log the columns found in the file for debugging
-            logger.info(f"Columns in {count_file}: {df.columns.tolist()}")
-            
-            if first_df is None:
-                first_df = df[['chr', 'start', 'end']]
-            
-            count_column = 'count'
-            
-            peak_counts[sample] = df[count_column]
-            
-        except Exception as e:
-            logger.error(f"Error reading {count_file}: {str(e)}")
-            raise
-    
-    # Create counts DataFrame
-    counts_df = pd.DataFrame(peak_counts)
-    
-    # Calculate means for BG (control) and BM (treatment) groups
-    bg_mean = counts_df[[col for col in counts_df.columns if col.startswith('BG')]].mean(axis=1)
-    bm_mean = counts_df[[col for col in counts_df.columns if col.startswith('BM')]].mean(axis=1)
-    
-    # Calculate mean intensity for filtering
+    return {prefix: [sample for sample in samples if sample.startswith(prefix)] for prefix in prefixes}
+
+def read_sample_sheet(sample_sheet):
+    """
+    Read a sample sheet assigning samples to conditions.
+
+    Args:
+        sample_sheet (str): Tab-separated file with 'sample' and 'condition' columns
+
+    Returns:
+        dict: {condition: [samples]}, in sheet order
+    """
+    sheet = pd.read_csv(sample_sheet, sep='\t', dtype=str)
+    missing = {'sample', 'condition'} - set(sheet.columns)
+    if missing:
+        raise ValueError(f"Sample sheet {sample_sheet} lacks columns: {sorted(missing)}")
+    return {condition: group['sample'].tolist() for condition, group in sheet.groupby('condition', sort=False)}
+
+def _resolve_samples(spec, conditions, samples):
+    """Samples named by a contrast side: a condition or comma-separated sample names."""
+    if spec in conditions:
+        return conditions[spec]
+    names = [name.strip() for name in spec.split(',')]
+    unknown = [name for name in names if name not in samples]
+    if unknown:
+        raise ValueError(f"Unknown samples or conditions in contrast: {unknown}")
+    return names
+
+def read_contrasts(contrasts_file, conditions, samples):
+    """
+    Read contrasts from a tab-separated file.
+
+    Args:
+        contrasts_file (str): File with 'control' and 'treatment' columns, each a
+                              condition or comma-separated sample names, and an
+                              optional 'name' column (default: <control>_<treatment>)
+        conditions (dict): {condition: [samples]}
+        samples (list): Samples in the count matrix
+
+    Returns:
+        list: Contrasts as {'name', 'control': [samples], 'treatment': [samples]}
+    """
+    table = pd.read_csv(contrasts_file, sep='\t', dtype=str)
+    contrasts = []
+    for row in table.itertuples(index=False):
+        name = getattr(row, 'name', None)
+        name = name if isinstance(name, str) and name else f"{row.control}_{row.treatment}".replace(',', '-')
+        contrasts.append({'name': name,
+                          'control': _resolve_samples(row.control, conditions, samples),
+                          'treatment': _resolve_samples(row.treatment, conditions, samples)})
+    return contrasts
+
+def all_pairs_contrasts(conditions, control='BG', treatment='BM'):
+    """
+    One contrast per (control sample, treatment sample) pair, named <control>_<treatment>.
+
+    Args:
+        conditions (dict): {condition: [samples]}
+        control (str): Control condition
+        treatment (str): Treatment condition
+
+    Returns:
+        list: Contrasts as {'name', 'control': [sample], 'treatment': [sample]}
+    """
+    return [{'name': f"{bg}_{bm}", 'control': [bg], 'treatment': [bm]}
+            for bg in conditions.get(control, []) for bm in conditions.get(treatment, [])]
+
+def contrast_statistics(counts, samples, contrasts, min_count=MIN_COUNT, pseudocount=PSEUDOCOUNT):
+    """
+    Group means, log2 fold changes and CV for all contrasts at once.
+
+    Each contrast side is a row of averaging weights over the samples, so all
+    group means come from one matrix product and every statistic is a
+    (regions x contrasts) array.
+
+    Args:
+        counts (numpy.ndarray): Normalized counts, regions x samples
+        samples (list): Sample names, in column order
+        contrasts (list): Contrasts as {'name', 'control', 'treatment'}
+        min_count (float): Minimum mean count in either group
+        pseudocount (float): Pseudocount for log2 fold changes
+
+    Returns:
+        dict: (regions x contrasts) arrays bg_mean, bm_mean, mean_intensity,
+              log2_fold_change (NaN for filtered regions), coefficient_of_variation,
+              and the moderated Welch test on log2(count + pseudocount) of the
+              regions passing the filter: t_statistic, df, p_value and padj
+              (Benjamini-Hochberg within each contrast; NaN without replicates)
+    """
+    column = {sample: i for i, sample in enumerate(samples)}
+    weights = np.zeros((2, len(contrasts), len(samples)))
+    for j, contrast in enumerate(contrasts):
+        for side, members in enumerate([contrast['control'], contrast['treatment']]):
+            if not members:
+                raise ValueError(f"Contrast {contrast['name']} has no samples on one side")
+            weights[side, j, [column[sample] for sample in members]] = 1.0 / len(members)
+
+    bg_mean, bm_mean = np.matmul(counts[None], weights.transpose(0, 2, 1))
     mean_intensity = (bg_mean + bm_mean) / 2
+    passed = (bg_mean >= min_count) | (bm_mean >= min_count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log2_fold_change = np.where(passed, np.log2((bm_mean + pseudocount) / (bg_mean + pseudocount)), np.nan)
+        cv = np.where(mean_intensity > 0, np.sqrt(np.var([bg_mean, bm_mean], axis=0)) / mean_intensity, np.nan)
     
-    # Filter out low count regions using minimum threshold
-    min_count = 5  # Minimum count threshold
-    mask = (bg_mean >= min_count) | (bm_mean >= min_count)
+    # Replicate-aware statistics, vectorized over regions for each contrast
+    log_counts = np.log2(counts + pseudocount)
+    tests = {key: np.full(bg_mean.shape, np.nan) for key in ['t_statistic', 'df', 'p_value', 'padj']}
+    for j, contrast in enumerate(contrasts):
+        control = [column[sample] for sample in contrast['control']]
+        treatment = [column[sample] for sample in contrast['treatment']]
+        if len(control) + len(treatment) < 3:
+            continue
+        test = moderated_welch_test(log_counts, control, treatment, rows=passed[:, j])
+        for key in ['t_statistic', 'df', 'p_value']:
+            tests[key][:, j] = test[key]
+        tests['padj'][:, j] = bh_adjust(test['p_value'])
+        logger.info(f"{contrast['name']}: variance prior df {test['prior_df']:.2f}, "
+                    f"prior variance {test['prior_variance']:.4f}")
     
-    # Create results dataframe with key metrics
+    return {'bg_mean': bg_mean, 'bm_mean': bm_mean, 'mean_intensity': mean_intensity,
+            'log2_fold_change': log2_fold_change, 'coefficient_of_variation': cv, **tests}
+
+def contrast_results(regions, stats, j):
+    """
+    Result table of one contrast, sorted by absolute log2 fold change.
+
+    Args:
+        regions (pandas.DataFrame): Regions with chr, start, end columns
+        stats (dict): Output of contrast_statistics
+        j (int): Contrast column
+
+    Returns:
+        pandas.DataFrame: chr, start, end, bg_mean, bm_mean, mean_intensity,
+                          log2_fold_change, coefficient_of_variation, t_statistic,
+                          df, p_value, padj
+    """
     results_df = pd.DataFrame({
-        'chr': first_df['chr'],
-        'start': first_df['start'],
-        'end': first_df['end'],
-        'bg_mean': bg_mean,
-        'bm_mean': bm_mean,
-        'mean_intensity': mean_intensity,
-        'passed_filter': mask
+        'chr': regions['chr'].astype(str).to_numpy(),
+        'start': regions['start'].to_numpy(),
+        'end': regions['end'].to_numpy(),
+        **{key: values[:, j] for key, values in stats.items()}
     })
-    
-    # Calculate log2 fold changes with pseudocount for filtered peaks
-    pseudocount = 1.0
-    results_df['log2_fold_change'] = np.where(
-        results_df['passed_filter'],
-        np.log2((results_df['bm_mean'] + pseudocount) / (results_df['bg_mean'] + pseudocount)),
-        np.nan
-    )
-    
-    # Add coefficient of variation as quality metric
-    results_df['coefficient_of_variation'] = np.where(
-        results_df['mean_intensity'] > 0,
-        np.sqrt(np.var([bg_mean, bm_mean], axis=0)) / results_df['mean_intensity'],
-        np.nan
-    )
-    
-    # Sort results by absolute fold change
     results_df['abs_fc'] = abs(results_df['log2_fold_change'])
     results_df = results_df.sort_values('abs_fc', ascending=False)
-    results_df = results_df.drop(['abs_fc', 'passed_filter'], axis=1)
-    
-    # Save results to file
-    results_df.to_csv(output_file, sep='\t', index=False)
-    
-    # Log summary statistics
+    return results_df.drop('abs_fc', axis=1)
+
+def log_contrast_summary(name, results_df):
+    """Log summary statistics of one contrast."""
     total_peaks = len(results_df)
     filtered_peaks = results_df['log2_fold_change'].notna().sum()
     
-    logger.info("Summary of comparisons:")
+    logger.info(f"Summary of comparison {name}:")
     logger.info(f"Total peaks analyzed: {total_peaks}")
     logger.info(f"Peaks passing filters: {filtered_peaks} ({filtered_peaks/total_peaks*100:.1f}%)")
-    logger.info(f"Mean BG signal: {bg_mean.mean():.2f}")
-    logger.info(f"Mean BM signal: {bm_mean.mean():.2f}")
+    logger.info(f"Mean BG signal: {results_df['bg_mean'].mean():.2f}")
+    logger.info(f"Mean BM signal: {results_df['bm_mean'].mean():.2f}")
     logger.info(f"Peaks up in BM (log2FC > 1): {(results_df['log2_fold_change'] > 1).sum()}")
     logger.info(f"Peaks down in BM (log2FC < -1): {(results_df['log2_fold_change'] < -1).sum()}")
-    
-    # Generate QC plot showing distribution of peak variability
+    if results_df['padj'].notna().any():
+        logger.info(f"Peaks with adjusted p-value < 0.05: {(results_df['padj'] < 0.05).sum()}")
+    else:
+        logger.info("No replicates on either side: p-values not computed")
+
+def plot_cv_qc(cv, output_png, labels=None):
+    """
+    Histogram of the coefficient of variation of one or more contrasts.
+
+    Args:
+        cv (numpy.ndarray): Coefficients of variation, regions x contrasts
+        output_png (str): Path to output figure
+        labels (list): Contrast names for a legend (default: no legend)
+    """
     plt.figure(figsize=(10, 5))
-    plt.hist(results_df['coefficient_of_variation'].dropna(), bins=50)
+    if labels is None:
+        plt.hist(cv[:, 0][~np.isnan(cv[:, 0])], bins=50)
+    else:
+        for j, label in enumerate(labels):
+            plt.hist(cv[:, j][~np.isnan(cv[:, j])], bins=50, histtype='step', label=label)
+        plt.legend(fontsize='small', ncol=2)
     plt.xlabel('Coefficient of Variation')
     plt.ylabel('Count')
     plt.title('Distribution of Peak Variability')
-    plt.savefig(f"{output_file}_qc.png")
+    plt.savefig(output_png)
     plt.close()
 
+def load_comparison_matrix(peak_count_files, unmatched_file, normalization=None):
+    """
+    Load count files into one coordinate-joined matrix and report unmatched regions.
+
+    Args:
+        peak_count_files (list): Count files or count matrices
+        unmatched_file (str): Where regions missing from some files are written
+        normalization (str): Re-normalize all samples together from their raw
+                             counts with one of NORMALIZATION_METHODS
+                             (default: use the stored normalized counts)
+
+    Returns:
+        dict: Joined table from count_tables.load_count_tables
+    """
+    try:
+        table, unmatched = load_count_tables(peak_count_files)
+    except Exception as e:
+        logger.error(f"Error reading count files: {str(e)}")
+        raise
+    
+    if len(unmatched):
+        unmatched.to_csv(unmatched_file, sep='\t', index=False)
+        logger.warning(f"Unmatched regions written to {unmatched_file}")
+    
+    if normalization:
+        if table['raw_counts'] is None:
+            raise ValueError("Re-normalization needs raw counts in every count file")
+        if normalization != 'median-of-ratios' and table['library_sizes'] is None:
+            raise ValueError(f"{normalization} normalization needs the library size table of every count file")
+        regions = table['regions']
+        normalized, size_factors = normalize_counts(
+            table['raw_counts'].T, table['library_sizes'], normalization,
+            lengths=regions['end'].to_numpy(dtype=np.int64) - regions['start'].to_numpy(dtype=np.int64))
+        table['counts'], table['normalization'] = normalized.T, normalization
+        logger.info(f"Re-normalized {len(table['samples'])} samples with {normalization}; size factors: "
+                    + ', '.join(f"{sample} {factor:.4g}" for sample, factor in zip(table['samples'], size_factors)))
+    logger.info(f"Comparing counts normalized with: {table['normalization'] or 'unknown'}")
+    return table
+
+def compare_peaks(peak_count_files, output_file, sample_name, threads=1, normalization=None):
+    """
+    Compare normalized peak counts between conditions.
+    
+    All BG samples are compared with all BM samples, by name prefix.
+    
+    Args:
+        peak_count_files (list): Count files or count matrices; samples are
+                                 assigned to BG and BM by name prefix
+        output_file (str): Path to output comparison file
+        sample_name (str): Name identifier for the comparison
+        threads (int): Number of threads to use (default: 1)
+        normalization (str): Re-normalize from raw counts (see load_comparison_matrix)
+    """
+    
+    # Create output directory if it doesn't exist
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    
+    table = load_comparison_matrix(peak_count_files, f"{output_file}_unmatched.txt", normalization)
+    conditions = conditions_from_prefix(table['samples'])
+    for group, members in conditions.items():
+        if not members:
+            raise ValueError(f"No {group} samples among {table['samples']}")
+    contrast = {'name': sample_name, 'control': conditions['BG'], 'treatment': conditions['BM']}
+    
+    stats = contrast_statistics(table['counts'], table['samples'], [contrast])
+    results_df = contrast_results(table['regions'], stats, 0)
+    
+    # Save results to file
+    results_df.to_csv(output_file, sep='\t', index=False)
+    log_contrast_summary(sample_name, results_df)
+    
+    # Generate QC plot showing distribution of peak variability
+    plot_cv_qc(stats['coefficient_of_variation'], f"{output_file}_qc.png")
+
+def compare_contrasts(peak_count_files, output_dir, sample_sheet=None, contrasts_file=None,
+                      normalization=None):
+    """
+    Compute many contrasts from one loaded count matrix and write all results.
+    
+    Without a contrasts file, every (BG sample, BM sample) pair is compared,
+    as in the per-pair run_smarcb1_analysis scripts.
+    
+    Args:
+        peak_count_files (list): Count files or count matrices
+        output_dir (str): Output directory
+        sample_sheet (str): Sample sheet with sample and condition columns
+                            (default: conditions BG and BM by name prefix)
+        contrasts_file (str): Contrast definitions (see read_contrasts)
+        normalization (str): Re-normalize from raw counts (see load_comparison_matrix)
+        
+    Output:
+        <output_dir>/promoter_comparison_<contrast>.txt per contrast (same format
+        as compare_peaks), contrast_summary.txt and contrast_cv_qc.png
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    table = load_comparison_matrix(peak_count_files, os.path.join(output_dir, 'unmatched_regions.txt'),
+                                   normalization)
+    samples = table['samples']
+    
+    conditions = read_sample_sheet(sample_sheet) if sample_sheet else conditions_from_prefix(samples)
+    conditions = {condition: [sample for sample in members if sample in samples]
+                  for condition, members in conditions.items()}
+    if contrasts_file:
+        contrasts = read_contrasts(contrasts_file, conditions, samples)
+    else:
+        contrasts = all_pairs_contrasts(conditions)
+    if not contrasts:
+        raise ValueError(f"No contrasts to compute for samples {samples}")
+    names = [contrast['name'] for contrast in contrasts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Contrast names are not unique: {names}")
+    logger.info(f"Computing {len(contrasts)} contrasts over {len(table['regions'])} regions "
+                f"and {len(samples)} samples")
+    
+    stats = contrast_statistics(table['counts'], samples, contrasts)
+    
+    summary = []
+    for j, contrast in enumerate(contrasts):
+        results_df = contrast_results(table['regions'], stats, j)
+        output_file = os.path.join(output_dir, f"promoter_comparison_{contrast['name']}.txt")
+        results_df.to_csv(output_file, sep='\t', index=False)
+        log_contrast_summary(contrast['name'], results_df)
+        summary.append({'contrast': contrast['name'],
+                        'control': ','.join(contrast['control']),
+                        'treatment': ','.join(contrast['treatment']),
+                        'normalization': table['normalization'],
+                        'regions': len(results_df),
+                        'passing_filter': int(results_df['log2_fold_change'].notna().sum()),
+                        'up': int((results_df['log2_fold_change'] > 1).sum()),
+                        'down': int((results_df['log2_fold_change'] < -1).sum()),
+                        'padj_below_0.05': int((results_df['padj'] < 0.05).sum()),
+                        'output_file': output_file})
+    
+    pd.DataFrame(summary).to_csv(os.path.join(output_dir, 'contrast_summary.txt'), sep='\t', index=False)
+    plot_cv_qc(stats['coefficient_of_variation'], os.path.join(output_dir, 'contrast_cv_qc.png'), labels=names)
+    logger.info(f"Wrote {len(contrasts)} comparisons to {output_dir}")
+
 def main():
     """Parse command line arguments and run peak comparison analysis"""
     parser = argparse.ArgumentParser(description='Compare peak sizes between BG and BM samples')
     parser.add_argument('--peak-counts', nargs='+', required=True,
-                        help='List of peak count files')
-    parser.add_argument('--output', required=True,
-                        help='Output comparison file')
-    parser.add_argument('--sample-name', required=True,
-                        help='Sample name')
+                        help='Peak count files, count matrices or .npz count matrices')
+    parser.add_argument('--output',
+                        help='Output comparison file (single BG vs BM comparison)')
+    parser.add_argument('--sample-name',
+                        help='Sample name (single comparison)')
+    parser.add_argument('--output-dir',
+                        help='Output directory for many contrasts from one matrix; without '
+                             '--contrasts every BG x BM sample pair is compared')
+    parser.add_argument('--sample-sheet',
+                        help='Tab-separated sample sheet with sample and condition columns '
+                             '(default: BG/BM by sample name prefix)')
+    parser.add_argument('--contrasts',
+                        help='Tab-separated contrasts with control, treatment and optional name columns; '
+                             'sides are conditions or comma-separated samples')
+    parser.add_argument('--normalization', choices=NORMALIZATION_METHODS,
+                        help='Re-normalize all samples together from raw counts '
+                             '(default: use the normalized counts in the files)')
     parser.add_argument('--threads', type=int, default=1,
                         help='Number of threads to use')
     
     args = parser.parse_args()
+    if args.output_dir is None and (args.output is None or args.sample_name is None):
+        parser.error('either --output and --sample-name, or --output-dir is required')
+    if args.output_dir is None and (args.sample_sheet or args.contrasts):
+        parser.error('--sample-sheet and --contrasts require --output-dir')
     
     try:
-        # Create output directory if it doesn't exist
-        os.makedirs(os.path.dirname(args.output), exist_ok=True)
-        
-        # Run analysis
-        compare_peaks(args.peak_counts, args.output, args.sample_name, threads=args.threads)
+        if args.output_dir:
+            compare_contrasts(args.peak_counts, args.output_dir, args.sample_sheet, args.contrasts,
+                              args.normalization)
+        else:
+            # Create output directory if it doesn't exist
+            os.makedirs(os.path.dirname(args.output), exist_ok=True)
+            
+            # Run analysis
+            compare_peaks(args.peak_counts, args.output, args.sample_name, threads=args.threads,
+                          normalization=args.normalization)
     except Exception as e:
         logger.error(f"Analysis failed: {str(e)}")
         raise
@@ -189,12 +455,15 @@ and treatment (BM) samples. Key steps include:
 
 1. Input Processing:
    - Reads normalized read count data from peak regions
+   - Joins samples on region coordinates and reports unmatched regions
    - Validates input files and data quality
    
 2. Signal Analysis:
    - Calculates mean signal for each condition (BG vs BM)
    - Applies minimum count threshold to filter low-signal regions
    - Computes log2 fold changes with pseudocount normalization
+   - Tests replicates with a moderated Welch t-test and BH correction
+   - Evaluates all contrasts of a sample sheet at once from one count matrix
    
 3. Quality Control:
    - Calculates coefficient of variation for peak reproducibility
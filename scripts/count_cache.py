@@ -0,0 +1,330 @@
+"""
+This module caches per-peak read counts so unchanged BAM files are never re-counted.
+
+Key features:
+- One .npz entry per (BAM file, peak set, counting parameters), holding the raw
+  counts and the library size used for RPM normalization
+- Entries are keyed by:
+  - a fingerprint of the BAM index (.bai/.csi) and the BAM file size, which
+    changes whenever the alignments change, but not when the BAM is moved
+  - a hash of the peak coordinates in counting order
+  - the counting parameters (count mode, fragment length limit, minimum MAPQ,
+    excluded SAM flags)
+- BAM header reference names are cached under the same fingerprint, so a cache
+  hit never opens the BAM file
+- Command line tooling to list entries and prune them by age, total size, or
+  BAM files that no longer exist or have changed
+
+Input:
+- Indexed BAM files and peak tables from count_reads_in_peaks.py
+- Optional cache directory (default: $AZENTA_CACHE_DIR/read_counts)
+
+Output:
+- Cache files in <cache_dir>/read_counts/
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from gene_index import DEFAULT_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Bump when the entry layout changes so stale entries are ignored
+CACHE_VERSION = 1
+
+# Fingerprints already computed in this process, keyed by (path, size, mtime)
+_fingerprints = {}
+
+
+def default_count_cache_dir():
+    """Default directory of the count cache."""
+    return os.path.join(DEFAULT_CACHE_DIR, 'read_counts')
+
+
+def find_bam_index(bam_file):
+    """
+    Locate the index of a BAM file.
+
+    Args:
+        bam_file (str): Path to BAM file
+
+    Returns:
+        str: Path to the .bai or .csi index
+
+    Raises:
+        ValueError: If no index file exists
+    """
+    stem = bam_file[:-4] if bam_file.endswith('.bam') else bam_file
+    for path in [f"{bam_file}.bai", f"{stem}.bai", f"{bam_file}.csi", f"{stem}.csi"]:
+        if os.path.exists(path):
+            return path
+    raise ValueError(f"BAM file is not indexed: {bam_file} (run samtools index)")
+
+
+def bam_fingerprint(bam_file):
+    """
+    Content fingerprint of a BAM file from its size and its index.
+
+    The index stores per-reference read totals and file offsets of every bin,
+    so any change to the alignments changes it.
+
+    Args:
+        bam_file (str): Path to indexed BAM file
+
+    Returns:
+        str: Hex digest
+    """
+    index_file = find_bam_index(bam_file)
+    bam_stat, index_stat = os.stat(bam_file), os.stat(index_file)
+    key = (os.path.abspath(bam_file), bam_stat.st_size, bam_stat.st_mtime_ns, index_stat.st_mtime_ns)
+    if key not in _fingerprints:
+        digest = hashlib.sha1(str(bam_stat.st_size).encode())
+        with open(index_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        _fingerprints[key] = digest.hexdigest()
+    return _fingerprints[key]
+
+
+def region_set_hash(peaks):
+    """
+    Hash of peak coordinates in row order.
+
+    Args:
+        peaks (pandas.DataFrame): Peaks with chr, start, end columns
+
+    Returns:
+        str: Hex digest
+    """
+    digest = hashlib.sha1()
+    digest.update('\t'.join(peaks['chr'].astype(str)).encode())
+    digest.update(peaks['start'].to_numpy(dtype=np.int64).tobytes())
+    digest.update(peaks['end'].to_numpy(dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+def _bam_name(bam_file):
+    """Short BAM name used as a readable cache file prefix."""
+    return os.path.basename(bam_file).split('.bam')[0]
+
+
+def _entry_path(cache_dir, bam_file, region_hash, params):
+    """Cache file for one BAM / peak set / parameter combination."""
+    key = f"{bam_fingerprint(bam_file)}|{region_hash}|{json.dumps(params, sort_keys=True)}|v{CACHE_VERSION}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:20]
+    return os.path.join(cache_dir, f"{_bam_name(bam_file)}.{digest}.npz")
+
+
+def _references_path(cache_dir, bam_file):
+    """Cache file of the BAM header reference names."""
+    return os.path.join(cache_dir, f"{_bam_name(bam_file)}.{bam_fingerprint(bam_file)[:20]}.references.json")
+
+
+def _write_atomic(path, write):
+    """Write a cache file through a temporary file so readers never see a partial entry."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_references(bam_file, cache_dir=None):
+    """
+    Cached BAM header reference names.
+
+    Args:
+        bam_file (str): Path to indexed BAM file
+        cache_dir (str): Cache directory (default: default_count_cache_dir())
+
+    Returns:
+        list: Reference names in header order, or None if not cached
+    """
+    path = _references_path(cache_dir or default_count_cache_dir(), bam_file)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_references(bam_file, references, cache_dir=None):
+    """Cache the BAM header reference names under the BAM fingerprint."""
+    path = _references_path(cache_dir or default_count_cache_dir(), bam_file)
+    _write_atomic(path, lambda f: f.write(json.dumps(list(references)).encode()))
+
+
+def load_counts(bam_file, peaks, params, cache_dir=None):
+    """
+    Look up cached counts.
+
+    Args:
+        bam_file (str): Path to indexed BAM file
+        peaks (pandas.DataFrame): Peaks with chr, start, end columns, in counting order
+        params (dict): Counting parameters
+        cache_dir (str): Cache directory (default: default_count_cache_dir())
+
+    Returns:
+        tuple: (library size, numpy.ndarray of raw counts per peak), or None on a miss
+    """
+    path = _entry_path(cache_dir or default_count_cache_dir(), bam_file, region_set_hash(peaks), params)
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        counts = data['counts'].astype(np.int64)
+        size = int(data['library_size'])
+    # Mark the entry as recently used for pruning
+    os.utime(path)
+    return size, counts
+
+
+def save_counts(bam_file, peaks, params, size, counts, cache_dir=None):
+    """
+    Store counts for one BAM file, peak set and parameter combination.
+
+    Args:
+        bam_file (str): Path to indexed BAM file
+        peaks (pandas.DataFrame): Peaks with chr, start, end columns, in counting order
+        params (dict): Counting parameters
+        size (int): Library size used for RPM normalization
+        counts (numpy.ndarray): Raw count per peak
+        cache_dir (str): Cache directory (default: default_count_cache_dir())
+    """
+    cache_dir = cache_dir or default_count_cache_dir()
+    path = _entry_path(cache_dir, bam_file, region_set_hash(peaks), params)
+    meta = {'bam': os.path.abspath(bam_file), 'fingerprint': bam_fingerprint(bam_file),
+            'regions': len(peaks), 'params': params, 'created': time.time()}
+    _write_atomic(path, lambda f: np.savez(f, counts=np.asarray(counts, dtype=np.int64),
+                                           library_size=np.int64(size),
+                                           meta=np.array(json.dumps(meta))))
+
+
+def list_count_cache(cache_dir=None):
+    """
+    Describe all count cache entries.
+
+    Args:
+        cache_dir (str): Cache directory (default: default_count_cache_dir())
+
+    Returns:
+        pandas.DataFrame: One row per entry with file, bam, regions, parameters,
+                          size_bytes, created and last_used (both as timestamps)
+    """
+    cache_dir = cache_dir or default_count_cache_dir()
+    rows = []
+    names = sorted(os.listdir(cache_dir)) if os.path.isdir(cache_dir) else []
+    for name in names:
+        if not name.endswith('.npz'):
+            continue
+        path = os.path.join(cache_dir, name)
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+        stat = os.stat(path)
+        rows.append({'file': name, 'bam': meta['bam'], 'fingerprint': meta['fingerprint'],
+                     'regions': meta['regions'],
+                     'params': ' '.join(f"{k}={v}" for k, v in sorted(meta['params'].items())),
+                     'size_bytes': stat.st_size,
+                     'created': pd.Timestamp(meta['created'], unit='s').floor('s'),
+                     'last_used': pd.Timestamp(stat.st_mtime, unit='s').floor('s')})
+    return pd.DataFrame(rows, columns=['file', 'bam', 'fingerprint', 'regions', 'params',
+                                       'size_bytes', 'created', 'last_used'])
+
+
+def _is_stale(bam_file, fingerprint):
+    """True if a BAM file no longer exists or no longer matches the fingerprint."""
+    try:
+        return bam_fingerprint(bam_file) != fingerprint
+    except (OSError, ValueError):
+        return True
+
+
+def prune_count_cache(cache_dir=None, max_bytes=None, older_than_days=None, stale=False):
+    """
+    Delete count cache entries.
+
+    Args:
+        cache_dir (str): Cache directory (default: default_count_cache_dir())
+        max_bytes (int): Evict least recently used entries until the cache fits
+        older_than_days (float): Delete entries not used for this many days
+        stale (bool): Delete entries whose BAM file is gone or has changed
+
+    Returns:
+        int: Number of deleted entries
+    """
+    cache_dir = cache_dir or default_count_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return 0
+    entries = list_count_cache(cache_dir).sort_values('last_used')
+    drop = pd.Series(False, index=entries.index)
+    if older_than_days is not None:
+        drop |= entries['last_used'] < pd.Timestamp(time.time() - older_than_days * 86400, unit='s')
+    if stale:
+        drop |= pd.Series([_is_stale(bam, fingerprint)
+                           for bam, fingerprint in zip(entries['bam'], entries['fingerprint'])],
+                          index=entries.index, dtype=bool)
+    if max_bytes is not None:
+        # Oldest first: keep dropping until what remains fits
+        kept_bytes = entries['size_bytes'].where(~drop, 0)
+        drop |= kept_bytes[::-1].cumsum()[::-1] > max_bytes
+
+    for name in entries.loc[drop, 'file']:
+        os.remove(os.path.join(cache_dir, name))
+        logger.info(f"Removed cached counts {name}")
+
+    # Header caches are dropped once no count entry refers to their fingerprint
+    kept = {fingerprint[:20] for fingerprint in entries.loc[~drop, 'fingerprint']}
+    for name in os.listdir(cache_dir):
+        if name.endswith('.references.json') and name.rsplit('.', 3)[-3] not in kept:
+            os.remove(os.path.join(cache_dir, name))
+    return int(drop.sum())
+
+
+def main():
+    """Parse command line arguments and list or prune the count cache."""
+    parser = argparse.ArgumentParser(description='List or prune cached read counts')
+    parser.add_argument('--cache-dir', default=default_count_cache_dir(),
+                        help='Count cache directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help='List cached entries')
+    prune = subparsers.add_parser('prune', help='Delete cached entries')
+    prune.add_argument('--max-gb', type=float,
+                       help='Evict least recently used entries until the cache fits in this size')
+    prune.add_argument('--older-than-days', type=float,
+                       help='Delete entries not used for this many days')
+    prune.add_argument('--stale', action='store_true',
+                       help='Delete entries whose BAM file is missing or has changed')
+    prune.add_argument('--all', action='store_true',
+                       help='Delete every entry')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        entries = list_count_cache(args.cache_dir)
+        if entries.empty:
+            logger.info(f"No cached counts in {args.cache_dir}")
+            return
+        with pd.option_context('display.max_colwidth', 80, 'display.width', 250):
+            print(entries.drop(columns='fingerprint').to_string(index=False))
+        logger.info(f"{len(entries)} entries, {entries['size_bytes'].sum() / 1024 ** 2:.1f} MB")
+    else:
+        max_bytes = 0 if args.all else (None if args.max_gb is None else int(args.max_gb * 1024 ** 3))
+        removed = prune_count_cache(args.cache_dir, max_bytes=max_bytes,
+                                    older_than_days=args.older_than_days, stale=args.stale)
+        logger.info(f"Removed {removed} cached count entries")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
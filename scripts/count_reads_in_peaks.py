@@ -2,147 +2,638 @@
 This script counts and normalizes reads in genomic peak regions from BAM files.
 
 Key features:
-- Processes BAM files to count reads overlapping peak regions
-- Normalizes counts to reads per million (RPM) 
+- Counts reads overlapping peak regions in-process with pysam, using indexed
+  fetches from the BAM index instead of a full pass over the file
+- Takes the total mapped reads for normalization from the BAM index
+  (samtools idxstats), without reading any alignments
+- Optionally counts paired-end fragments instead of reads: each proper pair
+  once, assigned by fragment midpoint or by overlap, in a streaming
+  mate-pairing pass (--count-mode)
+- Normalizes all samples together in memory (normalization.py): reads per
+  million (CPM/RPM, default), RPKM, median-of-ratios or TMM (--normalization),
+  and records the method and size factors in <output>_library_sizes.txt
+- Splits the peaks into genomic shards per chromosome and counts (BAM, shard)
+  tasks in a process pool, each worker with its own BAM handles; results are
+  merged back in peak order
+- Counts many BAM files concurrently into one regions x samples count matrix
+  with raw and normalized counts side by side (--bams)
 - Performs quality control checks on read counts
-- Handles temporary files and cleanup
+- Optionally skips reads below a mapping quality or with given SAM flags
+  (--min-mapq, --exclude-flags)
+- Caches counts per BAM file, peak set and counting parameters; BAM files
+  whose index is unchanged are not read again (see count_cache.py, --no-cache)
+- Needs no intermediate BED or BAM files
 - Provides detailed logging and error handling
 
 Input:
 - Peak regions in BED format
-- Aligned reads in BAM format
+- Aligned reads in a coordinate-sorted, indexed BAM file (.bai or .csi),
+  or several BAM files with --bams
 - Output file path for normalized counts
 - Sample name for identification
-- Optional number of threads
+- Optional number of worker processes (--threads) and shard size (--shard-size)
 
 Output:
-- Tab-separated file with normalized read counts per peak
+- Tab-separated file with normalized read counts per peak and a
+  <output>_library_sizes.txt table (library size, normalization, size factor)
+- With --bams: one count matrix (chr, start, end, gene, <sample>_raw_count,
+  <sample>_count per sample), or columnar arrays if the output ends in .npz,
+  and a <output>_library_sizes.txt table
 - Logging information and QC metrics
 """
 
 import argparse
-import subprocess
 import os
 import sys
+import numpy as np
 import pandas as pd
+import pysam
 import logging
+from multiprocessing import Pool
+
+from count_cache import load_counts, load_references, save_counts, save_references
+from count_tables import save_count_matrix_npz, write_library_sizes
+from normalization import MULTI_SAMPLE_METHODS, NORMALIZATION_METHODS, normalize_counts
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def count_reads(peaks_file, bam_file, output_file, sample_name, threads=1):
+# 'reads' counts every mapped record (bedtools coverage -counts); the fragment
+# modes count each proper pair once, by fragment midpoint or by any overlap
+COUNT_MODES = ['reads', 'fragment-midpoint', 'fragment-overlap']
+
+# Genomic shard length for parallel counting; each shard is one pool task
+DEFAULT_SHARD_SIZE = 10000000
+
+# BAM handles kept open inside each worker process
+_open_bams = {}
+
+def get_mapped_read_total(bam):
+    """
+    Total mapped reads from the BAM index, equivalent to `samtools view -c -F 4`.
+
+    Args:
+        bam (pysam.AlignmentFile): Open, indexed BAM file
+
+    Returns:
+        int: Number of mapped records over all reference sequences
+    """
+    return sum(stat.mapped for stat in bam.get_index_statistics())
+
+def read_peaks(peaks_file, chrom_order):
+    """
+    Read peak regions and sort them like `bedtools sort -g <BAM header>`.
+
+    Args:
+        peaks_file (str): Path to BED file with chr, start, end, gene columns
+        chrom_order (list): Reference names in BAM header order
+
+    Returns:
+        pandas.DataFrame: Peaks with columns chr, start, end, gene, ordered by
+                          header chromosome order, start and end. Peaks on
+                          chromosomes missing from the BAM header are placed last.
+    """
+    peaks = pd.read_csv(peaks_file, sep='\t', header=None, usecols=[0, 1, 2, 3],
+                        names=['chr', 'start', 'end', 'gene'],
+                        dtype={0: str, 1: np.int64, 2: np.int64, 3: str})
+    rank = peaks['chr'].map({chrom: i for i, chrom in enumerate(chrom_order)})
+    missing = rank.isna()
+    if missing.any():
+        logger.warning(f"{missing.sum()} peaks on chromosomes absent from the BAM header "
+                       f"will have zero counts: {sorted(peaks.loc[missing, 'chr'].unique())}")
+    order = np.lexsort((peaks['end'], peaks['start'], rank.fillna(len(chrom_order)).to_numpy()))
+    return peaks.iloc[order].reset_index(drop=True)
+
+def passes_read_filters(read, min_mapq=0, exclude_flags=0):
+    """True if a mapped read has at least `min_mapq` and none of `exclude_flags` set."""
+    return read.mapping_quality >= min_mapq and not read.flag & exclude_flags
+
+def count_peak_reads(bam, peaks, min_mapq=0, exclude_flags=0):
+    """
+    Count reads overlapping each peak with indexed fetches.
+
+    Every mapped record whose aligned span overlaps the half-open peak
+    interval by at least one base is counted, as in `bedtools coverage -counts`.
+
+    Args:
+        bam (pysam.AlignmentFile): Open, indexed BAM file
+        peaks (pandas.DataFrame): Peaks with chr, start, end columns
+        min_mapq (int): Minimum mapping quality
+        exclude_flags (int): Reads with any of these SAM flag bits are skipped
+
+    Returns:
+        numpy.ndarray: Raw read count per peak
+    """
+    counts = np.zeros(len(peaks), dtype=np.int64)
+    references = set(bam.references)
+    for i, (chrom, start, end) in enumerate(zip(peaks['chr'], peaks['start'], peaks['end'])):
+        if chrom not in references:
+            continue
+        for read in bam.fetch(chrom, start, end):
+            # Unmapped mates are stored at their partner's position; bedtools skips them
+            if not read.is_unmapped and passes_read_filters(read, min_mapq, exclude_flags):
+                counts[i] += 1
+    return counts
+
+def _peak_windows(starts, ends, pad):
+    """
+    Merge peaks (sorted by start) into fetch windows padded by `pad` bases.
+
+    Any fragment of at most `pad` bases that overlaps a peak lies entirely
+    inside that peak's window, so both of its mates are fetched together.
+
+    Returns:
+        list: (window start, window end, first peak row, last peak row + 1)
+    """
+    padded_starts = np.maximum(starts - pad, 0)
+    padded_ends = np.maximum.accumulate(ends + pad)
+    breaks = np.flatnonzero(padded_starts[1:] > padded_ends[:-1]) + 1
+    firsts = np.concatenate([[0], breaks])
+    lasts = np.concatenate([breaks, [len(starts)]])
+    return [(int(padded_starts[first]), int(padded_ends[last - 1]), first, last)
+            for first, last in zip(firsts, lasts)]
+
+def iter_fragments(bam, chrom, start, end, max_fragment_length=1000, min_mapq=0, exclude_flags=0,
+                   batch_size=1000000):
+    """
+    Stream proper-pair fragments from one window, pairing mates by name.
+
+    Reads arrive in coordinate order, so a mate waits in memory only until its
+    partner is reached; at most one batch of fragment coordinates is held.
+
+    Args:
+        bam (pysam.AlignmentFile): Open, indexed BAM file
+        chrom (str): Chromosome
+        start (int): Window start
+        end (int): Window end
+        max_fragment_length (int): Longer fragments are skipped
+        min_mapq (int): Minimum mapping quality of both mates
+        exclude_flags (int): Mates with any of these SAM flag bits are skipped,
+                             which drops their fragment
+        batch_size (int): Fragments per yielded batch
+
+    Yields:
+        tuple: (numpy.ndarray of fragment starts, numpy.ndarray of fragment ends)
+    """
+    pending = {}
+    frag_starts, frag_ends = [], []
+    for read in bam.fetch(chrom, start, end):
+        if (read.is_unmapped or read.mate_is_unmapped or not read.is_proper_pair
+                or read.is_secondary or read.is_supplementary
+                or not passes_read_filters(read, min_mapq, exclude_flags)):
+            continue
+        mate = pending.pop(read.query_name, None)
+        if mate is None:
+            pending[read.query_name] = (read.reference_start, read.reference_end)
+            continue
+        frag_start = min(mate[0], read.reference_start)
+        frag_end = max(mate[1], read.reference_end)
+        if frag_end - frag_start <= max_fragment_length:
+            frag_starts.append(frag_start)
+            frag_ends.append(frag_end)
+        if len(frag_starts) >= batch_size:
+            yield np.array(frag_starts, dtype=np.int64), np.array(frag_ends, dtype=np.int64)
+            frag_starts, frag_ends = [], []
+    if frag_starts:
+        yield np.array(frag_starts, dtype=np.int64), np.array(frag_ends, dtype=np.int64)
+
+def count_peak_fragments(bam, peaks, mode='fragment-midpoint', max_fragment_length=1000, min_mapq=0,
+                         exclude_flags=0):
+    """
+    Count proper-pair fragments per peak, each pair counted once.
+
+    Args:
+        bam (pysam.AlignmentFile): Open, indexed BAM file
+        peaks (pandas.DataFrame): Peaks from read_peaks (sorted by chromosome and start)
+        mode (str): 'fragment-midpoint' counts fragments whose midpoint lies in the
+                    peak; 'fragment-overlap' counts fragments overlapping the peak
+        max_fragment_length (int): Longer fragments are skipped
+        min_mapq (int): Minimum mapping quality of both mates
+        exclude_flags (int): Mates with any of these SAM flag bits are skipped
+
+    Returns:
+        numpy.ndarray: Raw fragment count per peak
+    """
+    counts = np.zeros(len(peaks), dtype=np.int64)
+    references = set(bam.references)
+    chroms = peaks['chr'].to_numpy()
+    starts = peaks['start'].to_numpy(dtype=np.int64)
+    ends = peaks['end'].to_numpy(dtype=np.int64)
+    
+    codes, names = pd.factorize(chroms)
+    for code, chrom in enumerate(names):
+        if chrom not in references:
+            continue
+        rows = np.flatnonzero(codes == code)
+        for win_start, win_end, first, last in _peak_windows(starts[rows], ends[rows], max_fragment_length):
+            window_rows = rows[first:last]
+            peak_starts, peak_ends = starts[window_rows], ends[window_rows]
+            for frag_starts, frag_ends in iter_fragments(bam, chrom, win_start, win_end,
+                                                         max_fragment_length, min_mapq, exclude_flags):
+                if mode == 'fragment-midpoint':
+                    midpoints = np.sort((frag_starts + frag_ends) // 2)
+                    counts[window_rows] += (np.searchsorted(midpoints, peak_ends, side='left')
+                                            - np.searchsorted(midpoints, peak_starts, side='left'))
+                else:
+                    # Fragments starting before the peak end minus those ending at or before its start
+                    counts[window_rows] += (np.searchsorted(np.sort(frag_starts), peak_ends, side='left')
+                                            - np.searchsorted(np.sort(frag_ends), peak_starts, side='right'))
+    return counts
+
+def count_peaks(bam, peaks, count_mode='reads', max_fragment_length=1000, min_mapq=0, exclude_flags=0):
+    """
+    Count reads or fragments per peak.
+
+    Args:
+        bam (pysam.AlignmentFile): Open, indexed BAM file
+        peaks (pandas.DataFrame): Peaks sorted by chromosome and start
+        count_mode (str): One of COUNT_MODES
+        max_fragment_length (int): Longest fragment counted in fragment modes
+        min_mapq (int): Minimum mapping quality
+        exclude_flags (int): Reads with any of these SAM flag bits are skipped
+
+    Returns:
+        numpy.ndarray: Raw count per peak
+    """
+    if count_mode == 'reads':
+        return count_peak_reads(bam, peaks, min_mapq, exclude_flags)
+    return count_peak_fragments(bam, peaks, count_mode, max_fragment_length, min_mapq, exclude_flags)
+
+def library_size(bam, count_mode='reads'):
+    """
+    Library size used for RPM normalization, from the BAM index.
+
+    Args:
+        bam (pysam.AlignmentFile): Open, indexed BAM file
+        count_mode (str): One of COUNT_MODES
+
+    Returns:
+        int: Mapped read total, or half of it (one fragment per properly
+             paired mate pair) in fragment modes. MAPQ and flag filters are
+             not applied, as the index holds only per-reference totals.
+    """
+    total_reads = get_mapped_read_total(bam)
+    return total_reads if count_mode == 'reads' else total_reads // 2
+
+def open_bam(bam_file, threads=1):
+    """
+    Open an indexed BAM file for counting.
+
+    Args:
+        bam_file (str): Path to BAM file
+        threads (int): Number of BAM decompression threads
+
+    Returns:
+        pysam.AlignmentFile: Open BAM file
+
+    Raises:
+        ValueError: If the BAM file has no index
+    """
+    bam = pysam.AlignmentFile(bam_file, 'rb', threads=threads)
+    if not bam.has_index():
+        bam.close()
+        raise ValueError(f"BAM file is not indexed: {bam_file} (run samtools index)")
+    return bam
+
+def bam_references(bam_file, use_cache=True):
+    """
+    Reference names in BAM header order, from the count cache when possible.
+
+    Args:
+        bam_file (str): Path to indexed BAM file
+        use_cache (bool): Read and update the cached header
+
+    Returns:
+        list: Reference names
+    """
+    references = load_references(bam_file) if use_cache else None
+    if references is None:
+        with open_bam(bam_file) as bam:
+            references = list(bam.references)
+        if use_cache:
+            save_references(bam_file, references)
+    return references
+
+def shard_peaks(peaks, shard_size=DEFAULT_SHARD_SIZE):
+    """
+    Split sorted peaks into genomic shards of at most `shard_size` bases per chromosome.
+
+    Args:
+        peaks (pandas.DataFrame): Peaks from read_peaks (sorted by chromosome and start)
+        shard_size (int): Shard length in bp
+
+    Returns:
+        list: Arrays of peak row positions, one per shard, largest shard first
+    """
+    if len(peaks) == 0:
+        return []
+    codes = pd.factorize(peaks['chr'])[0]
+    shard_ids = peaks['start'].to_numpy(dtype=np.int64) // shard_size
+    breaks = np.flatnonzero((np.diff(codes) != 0) | (np.diff(shard_ids) != 0)) + 1
+    shards = np.split(np.arange(len(peaks)), breaks)
+    # Start the biggest shards first so the pool finishes evenly
+    return sorted(shards, key=len, reverse=True)
+
+def counting_params(count_mode='reads', max_fragment_length=1000, min_mapq=0, exclude_flags=0):
+    """Counting parameters as a dict, as used for count cache keys."""
+    params = {'count_mode': count_mode, 'min_mapq': min_mapq, 'exclude_flags': exclude_flags}
+    if count_mode != 'reads':
+        params['max_fragment_length'] = max_fragment_length
+    return params
+
+def _count_shard_task(task):
+    """Worker: count one peak shard of one BAM with the worker's own file handle."""
+    bam_index, bam_file, rows, shard, params = task
+    if bam_file not in _open_bams:
+        _open_bams[bam_file] = open_bam(bam_file)
+    return bam_index, rows, count_peaks(_open_bams[bam_file], shard, **params)
+
+def count_bams(bam_files, peaks, processes=1, count_mode='reads', max_fragment_length=1000,
+               shard_size=DEFAULT_SHARD_SIZE, min_mapq=0, exclude_flags=0, use_cache=True):
+    """
+    Count reads or fragments in sorted peaks for several BAM files.
+    
+    BAM files with cached counts for these peaks and parameters are not opened.
+    For the rest, every (BAM, genomic shard) pair is a task for a process pool;
+    each worker opens its own BAM handles, and shard counts are merged back in
+    peak order.
+    
+    Args:
+        bam_files (list): Paths to indexed BAM files
+        peaks (pandas.DataFrame): Peaks from read_peaks
+        processes (int): Number of worker processes
+        count_mode (str): One of COUNT_MODES
+        max_fragment_length (int): Longest fragment counted in fragment modes
+        shard_size (int): Genomic shard length in bp
+        min_mapq (int): Minimum mapping quality
+        exclude_flags (int): Reads with any of these SAM flag bits are skipped
+        use_cache (bool): Read and update the count cache
+        
+    Returns:
+        tuple: (list of library sizes, numpy.ndarray of raw counts, BAMs x peaks)
+    """
+    params = counting_params(count_mode, max_fragment_length, min_mapq, exclude_flags)
+    regions = peaks[['chr', 'start', 'end']]
+    sizes = [None] * len(bam_files)
+    counts = np.zeros((len(bam_files), len(peaks)), dtype=np.int64)
+    
+    missing = []
+    for i, bam_file in enumerate(bam_files):
+        cached = load_counts(bam_file, regions, params) if use_cache else None
+        if cached is None:
+            missing.append(i)
+        else:
+            sizes[i], counts[i] = cached
+            logger.info(f"Loaded cached counts for {bam_file}")
+    if not missing:
+        return sizes, counts
+    
+    for i in missing:
+        with open_bam(bam_files[i]) as bam:
+            sizes[i] = library_size(bam, count_mode)
+    
+    shards = shard_peaks(regions, shard_size)
+    tasks = [(i, bam_files[i], rows, regions.iloc[rows], params)
+             for rows in shards for i in missing]
+    processes = max(1, min(processes, len(tasks)))
+    logger.info(f"Counting {len(missing)} BAM files in {len(shards)} genomic shards "
+                f"with {processes} processes...")
+    
+    if processes == 1:
+        for bam_index, rows, shard_counts in map(_count_shard_task, tasks):
+            counts[bam_index, rows] = shard_counts
+        for bam in _open_bams.values():
+            bam.close()
+        _open_bams.clear()
+    else:
+        with Pool(processes) as pool:
+            for bam_index, rows, shard_counts in pool.imap_unordered(_count_shard_task, tasks):
+                counts[bam_index, rows] = shard_counts
+    
+    if use_cache:
+        for i in missing:
+            save_counts(bam_files[i], regions, params, sizes[i], counts[i])
+    return sizes, counts
+
+def log_count_qc(raw_counts, total_reads, label):
+    """
+    Log QC warnings for one sample's counts.
+
+    Args:
+        raw_counts (numpy.ndarray): Raw read count per peak
+        total_reads (int): Total mapped reads of the sample
+        label (str): Sample name used in the messages
+    """
+    zero_peaks = (raw_counts == 0).sum()
+    if zero_peaks > len(raw_counts) * 0.5:
+        logger.warning(f"{label}: more than 50% of peaks have zero reads: {zero_peaks}/{len(raw_counts)}")
+    
+    if total_reads < 1000000:
+        logger.warning(f"{label}: low number of mapped reads: {total_reads}")
+
+def count_reads(peaks_file, bam_file, output_file, sample_name, threads=1, count_mode='reads',
+                max_fragment_length=1000, shard_size=DEFAULT_SHARD_SIZE, min_mapq=0, exclude_flags=0,
+                use_cache=True, normalization='cpm'):
     """
     Count and normalize reads in peak regions from a BAM file.
     
     Args:
         peaks_file (str): Path to BED file containing peak regions
-        bam_file (str): Path to BAM file containing aligned reads
+        bam_file (str): Path to indexed BAM file containing aligned reads
         output_file (str): Path to output file for normalized counts
         sample_name (str): Name identifier for the sample
-        threads (int): Number of threads to use (default: 1)
+        threads (int): Number of worker processes counting genomic shards (default: 1)
+        count_mode (str): One of COUNT_MODES (default: 'reads')
+        max_fragment_length (int): Longest fragment counted in fragment modes
+        shard_size (int): Genomic shard length in bp
+        min_mapq (int): Minimum mapping quality
+        exclude_flags (int): Reads with any of these SAM flag bits are skipped
+        use_cache (bool): Reuse and store counts in the count cache
+        normalization (str): 'cpm' or 'rpkm'; the other NORMALIZATION_METHODS
+                             need several samples (see count_matrix)
         
     The function:
-    1. Creates temporary working directories
-    2. Calculates total mapped reads for normalization
-    3. Sorts peaks using genome coordinates
-    4. Counts reads in peak regions
-    5. Normalizes counts to reads per million
-    6. Performs QC checks
-    7. Cleans up temporary files
+    1. Reads total mapped reads from the BAM index
+    2. Sorts peaks by the BAM header chromosome order
+    3. Counts reads in peak regions with indexed fetches, shard by shard
+    4. Normalizes counts to reads per million (or RPKM)
+    5. Performs QC checks
     """
-    
-    # Create output directory and temporary directory
+    if normalization in MULTI_SAMPLE_METHODS:
+        raise ValueError(f"{normalization} normalization needs several samples; count them with --bams")
     output_dir = os.path.dirname(output_file)
-    temp_dir = os.path.join(output_dir, 'tmp')
-    os.makedirs(output_dir, exist_ok=True)
-    os.makedirs(temp_dir, exist_ok=True)
-    
-    # Set up paths for temporary files
-    temp_prefix = os.path.join(temp_dir, os.path.basename(output_file))
-    genome_file = f"{temp_prefix}.genome"
-    sorted_peaks = f"{temp_prefix}.sorted.tmp"
-    counts_tmp = f"{temp_prefix}.counts.tmp"
-    
-    # Calculate total mapped reads for RPM normalization
-    logger.info("Calculating total mapped reads...")
-    total_reads_cmd = f"samtools view -c -F 4 {bam_file}"  # -F 4 excludes unmapped reads
-    total_reads = int(subprocess.check_output(total_reads_cmd, shell=True))
-    logger.info(f"Total mapped reads: {total_reads}")
-    
-    # Extract chromosome sizes from BAM header for proper sorting
-    logger.info("Creating genome file from BAM header...")
-    genome_cmd = f"samtools view -H {bam_file} | grep '^@SQ' | sed 's/@SQ\tSN://' | sed 's/\tLN:/\t/' > {genome_file}"
-    subprocess.run(genome_cmd, shell=True, check=True)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
     
     # Sort peak regions by genomic coordinates
-    logger.info("Sorting BED file...")
-    sort_cmd = f"bedtools sort -g {genome_file} -i {peaks_file} > {sorted_peaks}"
-    subprocess.run(sort_cmd, shell=True, check=True)
+    logger.info("Sorting peaks...")
+    df = read_peaks(peaks_file, bam_references(bam_file, use_cache))
     
-    try:
-        # Use bedtools coverage to count reads overlapping peaks
-        logger.info("Counting reads in peaks...")
-        cmd = (f"bedtools coverage -a {sorted_peaks} -b {bam_file} "
-               f"-sorted -g {genome_file} "
-               f"-counts > {counts_tmp}")
-        
-        subprocess.run(cmd, shell=True, check=True)
-        
-        # Load count data and add column names
-        df = pd.read_csv(counts_tmp, sep='\t', header=None,
-                         names=['chr', 'start', 'end', 'gene', 'raw_count'])
-        
-        # Convert raw counts to reads per million
-        df['count'] = df['raw_count'] * 1e6 / total_reads
+    # Count reads overlapping peaks; the library size comes from the BAM index
+    logger.info(f"Counting {count_mode} in {len(df)} peaks for {sample_name}...")
+    sizes, raw_counts = count_bams([bam_file], df, threads, count_mode, max_fragment_length, shard_size,
+                                   min_mapq, exclude_flags, use_cache)
+    total_reads = sizes[0]
+    df['raw_count'] = raw_counts[0]
+    logger.info(f"Library size for {normalization.upper()} normalization: {total_reads}")
+    
+    # Convert raw counts to reads per million (per kilobase for RPKM)
+    normalized, size_factors = normalize_counts(raw_counts, sizes, normalization,
+                                                lengths=(df['end'] - df['start']).to_numpy())
+    df['count'] = normalized[0]
+    
+    # Write normalized counts and the normalization record
+    df.to_csv(output_file, sep='\t', index=False)
+    write_library_sizes(output_file, [sample_name], sizes, normalization, size_factors)
+    
+    # Log summary statistics
+    logger.info(f"Normalized counts saved to {output_file}")
+    logger.info(f"Mean raw count: {df['raw_count'].mean():.2f}")
+    logger.info(f"Mean normalized count: {df['count'].mean():.2f}")
+    
+    # Perform quality control checks
+    log_count_qc(df['raw_count'].to_numpy(), total_reads, sample_name)
+
+def default_sample_name(bam_file):
+    """Sample name from a BAM path, e.g. results/bowtie2_alt/BG1.sorted.bam -> BG1."""
+    name = os.path.basename(bam_file)
+    for suffix in ['.bam', '.sorted', '.dedup']:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+def count_matrix(peaks_file, bam_files, output_file, sample_names=None, threads=1, count_mode='reads',
+                 max_fragment_length=1000, shard_size=DEFAULT_SHARD_SIZE, min_mapq=0, exclude_flags=0,
+                 use_cache=True, normalization='cpm'):
+    """
+    Count reads in one peak set for many BAM files and write a single count matrix.
+    
+    All (BAM, genomic shard) pairs are counted concurrently in one pool of
+    `threads` worker processes.
+    
+    Args:
+        peaks_file (str): Path to BED file containing peak regions
+        bam_files (list): Paths to indexed BAM files sharing one reference
+        output_file (str): Path to output count matrix
+        sample_names (list): Sample names in BAM order (default: from file names)
+        threads (int): Number of worker processes (default: 1)
+        count_mode (str): One of COUNT_MODES (default: 'reads')
+        max_fragment_length (int): Longest fragment counted in fragment modes
+        shard_size (int): Genomic shard length in bp
+        min_mapq (int): Minimum mapping quality
+        exclude_flags (int): Reads with any of these SAM flag bits are skipped
+        use_cache (bool): Reuse and store counts in the count cache
+        normalization (str): One of NORMALIZATION_METHODS (default: 'cpm')
         
-        # Write normalized counts to output file
+    Output:
+        Tab-separated matrix with one row per peak: chr, start, end, gene, then
+        <sample>_raw_count and <sample>_count (normalized) for each sample.
+        Library sizes, the normalization method and size factors per sample are
+        written to <output>_library_sizes.txt.
+        An output path ending in .npz stores the matrix as columnar arrays
+        instead (see count_tables.py), which loads without text parsing.
+    """
+    sample_names = sample_names or [default_sample_name(bam_file) for bam_file in bam_files]
+    if len(sample_names) != len(bam_files):
+        raise ValueError(f"Got {len(sample_names)} sample names for {len(bam_files)} BAM files")
+    if len(set(sample_names)) != len(sample_names):
+        raise ValueError(f"Sample names are not unique: {sample_names}")
+    
+    output_dir = os.path.dirname(output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    
+    # All BAMs must be aligned to the same reference for one shared peak order
+    references = bam_references(bam_files[0], use_cache)
+    for bam_file in bam_files[1:]:
+        if bam_references(bam_file, use_cache) != references:
+            raise ValueError(f"Reference sequences of {bam_file} differ from {bam_files[0]}")
+    
+    logger.info("Sorting peaks...")
+    df = read_peaks(peaks_file, references)
+    
+    logger.info(f"Counting {count_mode} in {len(df)} peaks for {len(bam_files)} BAM files...")
+    sizes, raw_counts = count_bams(bam_files, df, threads, count_mode, max_fragment_length, shard_size,
+                                   min_mapq, exclude_flags, use_cache)
+    
+    # All samples are normalized together
+    normalized, size_factors = normalize_counts(raw_counts, sizes, normalization,
+                                                lengths=(df['end'] - df['start']).to_numpy())
+    logger.info(f"Normalization: {normalization}")
+    
+    for sample, total_reads, size_factor, sample_counts, sample_normalized in zip(
+            sample_names, sizes, size_factors, raw_counts, normalized):
+        df[f'{sample}_raw_count'] = sample_counts
+        df[f'{sample}_count'] = sample_normalized
+        logger.info(f"{sample}: library size {total_reads}, size factor {size_factor:.4g}, "
+                    f"mean raw count {sample_counts.mean():.2f}")
+        log_count_qc(sample_counts, total_reads, sample)
+    
+    if output_file.endswith('.npz'):
+        save_count_matrix_npz(output_file, df, sample_names, raw_counts.T, normalized.T, sizes,
+                              normalization, size_factors)
+    else:
         df.to_csv(output_file, sep='\t', index=False)
-        
-        # Log summary statistics
-        logger.info(f"Normalized counts saved to {output_file}")
-        logger.info(f"Mean raw count: {df['raw_count'].mean():.2f}")
-        logger.info(f"Mean normalized count: {df['count'].mean():.2f}")
-        
-        # Perform quality control checks
-        zero_peaks = (df['raw_count'] == 0).sum()
-        if zero_peaks > len(df) * 0.5:
-            logger.warning(f"More than 50% of peaks have zero reads: {zero_peaks}/{len(df)}")
-        
-        if total_reads < 1000000:
-            logger.warning(f"Low number of mapped reads: {total_reads}")
-            
-    finally:
-        # Clean up all temporary files
-        for tmp_file in [counts_tmp, genome_file, sorted_peaks]:
-            if os.path.exists(tmp_file):
-                os.remove(tmp_file)
-        # Try to remove temp directory if empty
-        try:
-            os.rmdir(temp_dir)
-        except:
-            pass
+    write_library_sizes(output_file, sample_names, sizes, normalization, size_factors)
+    logger.info(f"Count matrix saved to {output_file}")
 
 def main():
     """Parse command line arguments and execute read counting."""
     parser = argparse.ArgumentParser(description='Count reads in peaks')
     parser.add_argument('--peaks', required=True,
                         help='Peaks bed file')
-    parser.add_argument('--bam', required=True,
-                        help='BAM file')
+    bam_group = parser.add_mutually_exclusive_group(required=True)
+    bam_group.add_argument('--bam',
+                           help='BAM file')
+    bam_group.add_argument('--bams', nargs='+',
+                           help='Several BAM files, counted concurrently into one count matrix')
     parser.add_argument('--output', required=True,
-                        help='Output counts file')
-    parser.add_argument('--sample-name', required=True,
-                        help='Sample name')
+                        help='Output counts file (or count matrix with --bams; .npz for columnar arrays)')
+    parser.add_argument('--sample-name',
+                        help='Sample name (required with --bam)')
+    parser.add_argument('--sample-names', nargs='+',
+                        help='Sample names for --bams (default: BAM file names)')
     parser.add_argument('--threads', type=int, default=1,
-                       help='Number of threads to use')
+                       help='Number of worker processes counting genomic shards')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help=f'Genomic shard length in bp for parallel counting (default: {DEFAULT_SHARD_SIZE})')
+    parser.add_argument('--count-mode', choices=COUNT_MODES, default='reads',
+                        help='Count every read, or each proper pair once by fragment midpoint '
+                             'or fragment overlap (default: reads)')
+    parser.add_argument('--max-fragment-length', type=int, default=1000,
+                        help='Longest fragment counted in fragment modes (default: 1000)')
+    parser.add_argument('--min-mapq', type=int, default=0,
+                        help='Minimum mapping quality (default: 0)')
+    parser.add_argument('--exclude-flags', type=lambda value: int(value, 0), default=0,
+                        help='Skip reads with any of these SAM flag bits, e.g. 0x400 for '
+                             'duplicates (default: 0)')
+    parser.add_argument('--normalization', choices=NORMALIZATION_METHODS, default='cpm',
+                        help='Normalization of the count columns (default: cpm, i.e. RPM); '
+                             'median-of-ratios and tmm need --bams')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always count from the BAM files and do not update the count cache '
+                             '(manage the cache with count_cache.py)')
     
     args = parser.parse_args()
+    if args.bam and not args.sample_name:
+        parser.error('--sample-name is required with --bam')
     
     try:
-        count_reads(args.peaks, args.bam, args.output, args.sample_name, threads=args.threads)
+        if args.bams:
+            count_matrix(args.peaks, args.bams, args.output, sample_names=args.sample_names,
+                         threads=args.threads, count_mode=args.count_mode,
+                         max_fragment_length=args.max_fragment_length, shard_size=args.shard_size,
+                         min_mapq=args.min_mapq, exclude_flags=args.exclude_flags,
+                         use_cache=not args.no_cache, normalization=args.normalization)
+        else:
+            count_reads(args.peaks, args.bam, args.output, args.sample_name, threads=args.threads,
+                        count_mode=args.count_mode, max_fragment_length=args.max_fragment_length,
+                        shard_size=args.shard_size, min_mapq=args.min_mapq,
+                        exclude_flags=args.exclude_flags, use_cache=not args.no_cache,
+                        normalization=args.normalization)
     except Exception as e:
-        logger.error(f"Error processing {args.bam}: {str(e)}")
+        logger.error(f"Error processing {args.bam or ', '.join(args.bams)}: {str(e)}")
         sys.exit(1)
 
 if __name__ == '__main__':
@@ -153,10 +644,12 @@ Summary:
 This script is designed for ChIP-seq data analysis, specifically counting reads in peak regions.
 It takes aligned sequencing reads (BAM) and peak regions (BED) as input, then:
 
-1. Processes the BAM file to count total mapped reads
-2. Ensures proper sorting of peak regions using chromosome coordinates
-3. Uses bedtools to count reads overlapping each peak region
-4. Normalizes raw counts to reads per million (RPM) to account for sequencing depth
+1. Reads the total mapped reads from the BAM index
+2. Sorts peak regions by the BAM header chromosome order
+3. Counts reads overlapping each peak region with indexed pysam fetches,
+   split into genomic shards counted in parallel worker processes
+4. Normalizes raw counts to reads per million (RPM) to account for sequencing depth,
+   or with RPKM, median-of-ratios or TMM for all samples at once
 5. Performs quality control checks for:
    - Peaks with zero reads
    - Low total read counts
@@ -166,7 +659,8 @@ It takes aligned sequencing reads (BAM) and peak regions (BED) as input, then:
    - Raw read counts
    - Normalized RPM values
 7. Provides detailed logging throughout the process
-8. Handles temporary files and cleanup automatically
+8. Runs entirely in-process, without external tools or temporary files
+9. Reuses cached counts when neither the BAM file nor the peaks have changed
 
 The script is commonly used in ChIP-seq workflows to quantify protein binding
 or histone modification levels at specific genomic regions.
@@ -0,0 +1,318 @@
+"""
+This module loads per-peak count tables into coordinate-indexed matrices.
+
+Key features:
+- Reads every count format written by count_reads_in_peaks.py:
+  - single-sample tables (chr, start, end, gene, raw_count, count)
+  - tab-separated count matrices (<sample>_raw_count and <sample>_count columns)
+  - columnar .npz count matrices, loaded without any text parsing
+- Compact coordinates: categorical chromosome plus int32 start and end
+- Joins several tables on their coordinates with one stable sort-merge, which
+  runs in linear time for the coordinate-sorted tables written by the counter
+- Reports regions missing from some tables instead of misaligning rows
+- Library sizes and the normalization method from the .npz matrix or the
+  <output>_library_sizes.txt table
+
+Input:
+- Count tables or matrices from count_reads_in_peaks.py
+
+Output:
+- dict with 'regions' (pandas.DataFrame), 'samples' (list), 'counts' and
+  'raw_counts' (numpy.ndarray, regions x samples), 'library_sizes' and
+  'normalization'
+"""
+
+import logging
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Column suffixes of the per-sample columns in a count matrix
+RAW_COUNT_SUFFIX = '_raw_count'
+COUNT_SUFFIX = '_count'
+
+# Single-sample count files are named <sample>_promoter_counts.txt
+SINGLE_SAMPLE_SUFFIX = '_promoter_counts.txt'
+
+
+def library_sizes_path(output_file):
+    """Path of the library size table written next to a count matrix."""
+    return f"{os.path.splitext(output_file)[0]}_library_sizes.txt"
+
+
+def write_library_sizes(output_file, samples, library_sizes, normalization, size_factors):
+    """
+    Write the library size table of a count file.
+
+    Args:
+        output_file (str): Count file or count matrix the table belongs to
+        samples (list): Sample names
+        library_sizes (list): Library size per sample
+        normalization (str): Normalization method of the count columns
+        size_factors (list): Size factor per sample used by that method
+    """
+    pd.DataFrame({'sample': samples, 'total_mapped_reads': library_sizes,
+                  'normalization': normalization, 'size_factor': size_factors}).to_csv(
+        library_sizes_path(output_file), sep='\t', index=False)
+
+
+def compact_regions(chroms, starts, ends, genes=None):
+    """
+    Region table with a categorical chromosome and int32 coordinates.
+
+    Args:
+        chroms (array-like): Chromosome names
+        starts (array-like): Start coordinates
+        ends (array-like): End coordinates
+        genes (array-like): Optional gene names
+
+    Returns:
+        pandas.DataFrame: Columns chr, start, end (and gene)
+    """
+    regions = pd.DataFrame({
+        'chr': pd.Categorical(np.asarray(chroms, dtype=str)),
+        'start': np.asarray(starts, dtype=np.int32),
+        'end': np.asarray(ends, dtype=np.int32),
+    })
+    if genes is not None:
+        regions['gene'] = np.asarray(genes, dtype=object)
+    return regions
+
+
+def save_count_matrix_npz(output_file, regions, samples, raw_counts, counts, library_sizes,
+                          normalization='cpm', size_factors=None):
+    """
+    Write a count matrix as columnar arrays in an .npz file.
+
+    Args:
+        output_file (str): Path to .npz file
+        regions (pandas.DataFrame): Regions with chr, start, end, gene columns
+        samples (list): Sample names
+        raw_counts (numpy.ndarray): Raw counts, regions x samples
+        counts (numpy.ndarray): Normalized counts, regions x samples
+        library_sizes (list): Library size per sample
+        normalization (str): Normalization method of `counts`
+        size_factors (list): Size factor per sample (default: library size / 1e6)
+    """
+    if size_factors is None:
+        size_factors = np.asarray(library_sizes, dtype=np.float64) / 1e6
+    chrom = pd.Categorical(regions['chr'].astype(str))
+    arrays = {
+        'chrom_codes': chrom.codes.astype(np.int16),
+        'chrom_names': np.asarray(chrom.categories, dtype=str),
+        'start': regions['start'].to_numpy(dtype=np.int32),
+        'end': regions['end'].to_numpy(dtype=np.int32),
+        'gene': regions['gene'].astype(str).to_numpy(dtype=str),
+        'samples': np.asarray(samples, dtype=str),
+        'raw_counts': np.asarray(raw_counts, dtype=np.int64),
+        'counts': np.asarray(counts, dtype=np.float64),
+        'library_sizes': np.asarray(library_sizes, dtype=np.int64),
+        'normalization': np.array(normalization),
+        'size_factors': np.asarray(size_factors, dtype=np.float64),
+    }
+    # Write to a temporary file first so readers never see a partial matrix
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_file) or '.', suffix='.npz.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, output_file)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _load_npz(count_file):
+    """Read a count matrix written by save_count_matrix_npz."""
+    with np.load(count_file, allow_pickle=False) as data:
+        chrom = pd.Categorical.from_codes(data['chrom_codes'], categories=data['chrom_names'])
+        regions = pd.DataFrame({'chr': chrom, 'start': data['start'], 'end': data['end'],
+                                'gene': data['gene'].astype(object)})
+        return {'regions': regions, 'samples': data['samples'].tolist(),
+                'raw_counts': data['raw_counts'], 'counts': data['counts'],
+                'library_sizes': data['library_sizes'].tolist(),
+                'normalization': str(data['normalization']) if 'normalization' in data else None}
+
+
+def _read_library_sizes(count_file, samples):
+    """(library sizes, normalization) from the table written next to a count file, or (None, None)."""
+    path = library_sizes_path(count_file)
+    if not os.path.exists(path):
+        return None, None
+    table = pd.read_csv(path, sep='\t').set_index('sample')
+    if not set(samples) <= set(table.index):
+        return None, None
+    # Tables written before normalization methods were recorded hold RPM counts
+    normalization = table['normalization'].iloc[0] if 'normalization' in table.columns else 'cpm'
+    return table.loc[samples, 'total_mapped_reads'].astype(np.int64).tolist(), normalization
+
+
+def load_count_table(count_file):
+    """
+    Load one count table or count matrix.
+
+    Args:
+        count_file (str): Single-sample table, tab-separated count matrix or .npz matrix
+
+    Returns:
+        dict: 'regions' (chr, start, end, gene), 'samples', 'counts' and
+              'raw_counts' (regions x samples; raw_counts may be None),
+              'library_sizes' (list) and 'normalization' (None if unknown)
+
+    Raises:
+        FileNotFoundError: If the file does not exist
+        ValueError: If the file has no count columns
+    """
+    if not os.path.exists(count_file):
+        raise FileNotFoundError(f"Count file not found: {count_file}")
+    if count_file.endswith('.npz'):
+        return _load_npz(count_file)
+
+    df = pd.read_csv(count_file, sep='\t', dtype={'chr': str, 'gene': str})
+    genes = df['gene'] if 'gene' in df.columns else None
+    regions = compact_regions(df['chr'], df['start'], df['end'], genes)
+
+    if 'count' in df.columns:
+        samples = [os.path.basename(count_file).replace(SINGLE_SAMPLE_SUFFIX, '')]
+        count_columns, raw_columns = ['count'], ['raw_count']
+    else:
+        samples = [column[:-len(COUNT_SUFFIX)] for column in df.columns
+                   if column.endswith(COUNT_SUFFIX) and not column.endswith(RAW_COUNT_SUFFIX)]
+        count_columns = [f'{sample}{COUNT_SUFFIX}' for sample in samples]
+        raw_columns = [f'{sample}{RAW_COUNT_SUFFIX}' for sample in samples]
+    if not samples:
+        raise ValueError(f"No count columns in {count_file}")
+
+    has_raw = all(column in df.columns for column in raw_columns)
+    library_sizes, normalization = _read_library_sizes(count_file, samples)
+    return {'regions': regions, 'samples': samples,
+            'counts': df[count_columns].to_numpy(dtype=np.float64),
+            'raw_counts': df[raw_columns].to_numpy(dtype=np.int64) if has_raw else None,
+            'library_sizes': library_sizes, 'normalization': normalization}
+
+
+def _region_keys(regions, categories):
+    """Chromosome codes in shared categories, starts, ends and duplicate ranks."""
+    codes = pd.Categorical(regions['chr'].astype(str), categories=categories).codes.astype(np.int64)
+    starts = regions['start'].to_numpy(dtype=np.int64)
+    ends = regions['end'].to_numpy(dtype=np.int64)
+    # Repeated coordinates (one promoter listed for several genes) are matched by occurrence
+    ranks = pd.DataFrame({'c': codes, 's': starts, 'e': ends}).groupby(['c', 's', 'e']).cumcount().to_numpy()
+    return codes, starts, ends, ranks
+
+
+def join_count_tables(tables):
+    """
+    Join count tables on region coordinates.
+
+    All tables are stacked and stably sorted by (chromosome, start, end,
+    duplicate rank, table); a region is kept if every table holds it. When all
+    tables share the same coordinates in the same order this is a plain stack.
+
+    Args:
+        tables (list): Tables from load_count_table
+
+    Returns:
+        tuple: (joined table dict with the samples of all tables in order,
+                pandas.DataFrame of unmatched regions with chr, start, end and
+                'missing_from' listing the tables lacking them)
+    """
+    first = tables[0]['regions']
+    same_layout = all(
+        len(table['regions']) == len(first)
+        and np.array_equal(table['regions']['chr'].astype(str).to_numpy(), first['chr'].astype(str).to_numpy())
+        and np.array_equal(table['regions']['start'].to_numpy(), first['start'].to_numpy())
+        and np.array_equal(table['regions']['end'].to_numpy(), first['end'].to_numpy())
+        for table in tables[1:])
+    if same_layout:
+        rows = [np.arange(len(first))] * len(tables)
+        regions = first
+        unmatched = pd.DataFrame(columns=['chr', 'start', 'end', 'missing_from'])
+    else:
+        categories = pd.unique(np.concatenate([table['regions']['chr'].astype(str).to_numpy()
+                                               for table in tables]))
+        keys = [_region_keys(table['regions'], categories) for table in tables]
+        codes, starts, ends, ranks = (np.concatenate(column) for column in zip(*keys))
+        table_ids = np.concatenate([np.full(len(k[0]), i) for i, k in enumerate(keys)])
+        positions = np.concatenate([np.arange(len(k[0])) for k in keys])
+
+        # Sorted tables form presorted runs, so the stable sort is a linear merge
+        order = np.lexsort((table_ids, ranks, ends, starts, codes))
+        key_change = np.ones(len(order), dtype=bool)
+        key_change[1:] = ((np.diff(codes[order]) != 0) | (np.diff(starts[order]) != 0)
+                          | (np.diff(ends[order]) != 0) | (np.diff(ranks[order]) != 0))
+        group_starts = np.flatnonzero(key_change)
+        group_sizes = np.diff(np.append(group_starts, len(order)))
+        complete = group_sizes == len(tables)
+
+        matched = group_starts[complete]
+        rows = [positions[order[matched + i]] for i in range(len(tables))]
+        regions = tables[0]['regions'].iloc[rows[0]].reset_index(drop=True)
+
+        # Regions absent from at least one table
+        partial = np.repeat(~complete, group_sizes)
+        members = order[partial]
+        group_of = np.repeat(np.arange(len(group_starts)), group_sizes)[partial]
+        present = pd.DataFrame({'group': group_of, 'table': table_ids[members],
+                                'chr': categories[codes[members]], 'start': starts[members],
+                                'end': ends[members]})
+        unmatched = present.groupby('group').agg(
+            chr=('chr', 'first'), start=('start', 'first'), end=('end', 'first'),
+            missing_from=('table', lambda t: ','.join(str(i) for i in range(len(tables))
+                                                      if i not in set(t)))).reset_index(drop=True)
+
+    def stacked(key):
+        if any(table[key] is None for table in tables):
+            return None
+        return np.hstack([table[key][table_rows] for table, table_rows in zip(tables, rows)])
+
+    sizes = [table['library_sizes'] for table in tables]
+    methods = {table['normalization'] for table in tables}
+    joined = {'regions': regions.reset_index(drop=True),
+              'samples': [sample for table in tables for sample in table['samples']],
+              'counts': stacked('counts'), 'raw_counts': stacked('raw_counts'),
+              'library_sizes': None if any(s is None for s in sizes) else [x for s in sizes for x in s],
+              'normalization': methods.pop() if len(methods) == 1 else None}
+    return joined, unmatched
+
+
+def load_count_tables(count_files):
+    """
+    Load several count tables or matrices into one coordinate-joined matrix.
+
+    Args:
+        count_files (list): Paths accepted by load_count_table
+
+    Returns:
+        tuple: (joined table dict, pandas.DataFrame of unmatched regions with
+                'missing_from' naming the files lacking them)
+
+    Raises:
+        ValueError: If sample names repeat or no region is shared by all files
+    """
+    tables = []
+    for count_file in count_files:
+        logger.info(f"Reading {count_file}...")
+        tables.append(load_count_table(count_file))
+        logger.info(f"{count_file}: {len(tables[-1]['regions'])} regions, "
+                    f"samples {', '.join(tables[-1]['samples'])}")
+
+    joined, unmatched = join_count_tables(tables)
+    if len(set(joined['samples'])) != len(joined['samples']):
+        raise ValueError(f"Sample names are not unique: {joined['samples']}")
+    if len(unmatched):
+        unmatched['missing_from'] = unmatched['missing_from'].map(
+            lambda ids: ','.join(os.path.basename(count_files[int(i)]) for i in ids.split(',')))
+        logger.warning(f"{len(unmatched)} regions are not present in every count file and were dropped")
+        for name, n in unmatched['missing_from'].value_counts().items():
+            logger.warning(f"  missing from {name}: {n} regions")
+    if len(joined['regions']) == 0:
+        raise ValueError("No regions are shared by all count files")
+    methods = {table['normalization'] for table in tables}
+    if len(methods) > 1:
+        logger.warning(f"Count files were normalized differently: {sorted(map(str, methods))}")
+    return joined, unmatched
@@ -3,7 +3,8 @@ This script creates promoter regions in BED format for a list of genes.
 
 Key features:
 - Reads gene list from input file
-- Extracts gene coordinates from GTF annotation file
+- Extracts gene coordinates from the GTF annotation, indexed and cached by gene_index.py
+- Resolves the whole gene list in one batch against the cached gene index
 - Creates promoter regions with configurable upstream/downstream distances
 - Outputs promoter regions in BED format
 - Handles both gzipped and uncompressed GTF files
@@ -22,78 +23,59 @@ Output:
 """
 
 import pandas as pd
+import numpy as np
 import argparse
 import logging
-import gzip
 import os
 
+from gene_index import load_gene_index
+
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def parse_gtf_line(line):
-    """
-    Parse a single line from a GTF file and extract relevant fields.
-    
-    Args:
-        line (str): A line from GTF file
-        
-    Returns:
-        dict: Dictionary containing parsed fields (chrom, start, end, strand, gene_name, feature)
-             Returns None if line cannot be parsed
+def build_promoter_regions(genes, gene_index, upstream=2000, downstream=500):
     """
-    fields = line.strip().split('\t')
-    if len(fields) < 9:
-        return None
-    
-    chrom, source, feature, start, end, score, strand, frame, attributes = fields
-    
-    # Parse GTF attributes field into dictionary
-    attr_dict = {}
-    for attr in attributes.split(';'):
-        if attr.strip():
-            key, value = attr.strip().split(' ', 1)
-            attr_dict[key] = value.strip('"')
+    Resolve a whole gene list against the gene index and build promoter windows.
     
-    return {
-        'chrom': chrom,
-        'start': int(start),
-        'end': int(end),
-        'strand': strand,
-        'gene_name': attr_dict.get('gene_name', ''),
-        'feature': feature
-    }
-
-def get_gene_coordinates(gene, gtf_file):
-    """
-    Extract coordinates for a specific gene from GTF file.
+    Each gene is resolved to its first gene record in the GTF, as indexed by
+    scripts.gene_index; promoter windows are computed for all genes at once.
     
     Args:
-        gene (str): Gene name to search for
-        gtf_file (str): Path to GTF annotation file
+        genes (list): Gene names, in the desired output order
+        gene_index (pandas.DataFrame): Gene index from gene_index.load_gene_index
+        upstream (int): Base pairs upstream of TSS to include
+        downstream (int): Base pairs downstream of TSS to include
         
     Returns:
-        dict: Gene coordinates and metadata if found, None otherwise
+        tuple: (promoters DataFrame with columns chr, start, end, gene;
+                list of gene names that could not be resolved)
     """
-    # Handle gzipped or regular files
-    if gtf_file.endswith('.gz'):
-        opener = gzip.open
-    else:
-        opener = open
+    first_records = gene_index.drop_duplicates('gene_name', keep='first').set_index('gene_name')
     
-    with opener(gtf_file, 'rt') as f:
-        for line in f:
-            if line.startswith('#'):  # Skip header lines
-                continue
-            
-            parsed = parse_gtf_line(line)
-            if parsed and parsed['feature'] == 'gene' and parsed['gene_name'] == gene:
-                return parsed
+    wanted = pd.Index(genes)
+    found = wanted.isin(first_records.index)
+    resolved = first_records.loc[wanted[found]]
     
-    return None
+    # Strand-aware promoter arithmetic over all genes at once
+    plus = (resolved['strand'] == '+').to_numpy()
+    start = resolved['start'].to_numpy(dtype=np.int64)
+    end = resolved['end'].to_numpy(dtype=np.int64)
+    prom_start = np.where(plus, start - upstream, end - downstream).clip(min=0)
+    prom_end = np.where(plus, start + downstream, end + upstream)
+    
+    promoters = pd.DataFrame({
+        'chr': resolved['chrom'].astype(str).to_numpy(),
+        'start': prom_start,
+        'end': prom_end,
+        'gene': wanted[found].to_numpy()
+    })
+    unresolved = wanted[~found].tolist()
+    return promoters, unresolved
 
 def create_promoter_regions(gene_list_file, output_file, upstream=2000, downstream=500, 
-                          gtf_file="/beegfs/datasets/genomes/mm10/annotation/gencode.vM25.annotation.gtf.gz"):
+                          gtf_file="/beegfs/datasets/genomes/mm10/annotation/gencode.vM25.annotation.gtf.gz",
+                          unresolved_file=None):
     """
     Create BED file containing promoter regions for specified genes.
     
@@ -103,6 +85,7 @@ def create_promoter_regions(gene_list_file, output_file, upstream=2000, downstre
         upstream (int): Base pairs upstream of TSS to include
         downstream (int): Base pairs downstream of TSS to include
         gtf_file (str): Path to GTF annotation file
+        unresolved_file (str): Optional path to write genes missing from the GTF
         
     Raises:
         FileNotFoundError: If GTF file not found
@@ -119,34 +102,24 @@ def create_promoter_regions(gene_list_file, output_file, upstream=2000, downstre
     
     logger.info(f"Processing {len(genes)} genes using GTF file: {gtf_file}")
     
-    # Process each gene to get promoter coordinates
-    promoters = []
-    for gene in genes:
-        logger.info(f"Getting coordinates for {gene}")
-        coords = get_gene_coordinates(gene, gtf_file)
-        if coords:
-            # Calculate promoter region based on strand
-            if coords['strand'] == '+':
-                prom_start = max(0, coords['start'] - upstream)
-                prom_end = coords['start'] + downstream
-            else:
-                prom_start = max(0, coords['end'] - downstream)
-                prom_end = coords['end'] + upstream
-            
-            promoters.append([
-                coords['chrom'],
-                prom_start,
-                prom_end,
-                gene
-            ])
-        else:
-            logger.warning(f"Could not find coordinates for {gene}")
+    # Resolve all genes against the gene index in one batch
+    gene_index = load_gene_index(gtf_file)
+    df, unresolved = build_promoter_regions(genes, gene_index, upstream, downstream)
+    
+    # Report unresolved genes once instead of per gene
+    if unresolved:
+        preview = ', '.join(unresolved[:10])
+        more = f" (and {len(unresolved) - 10} more)" if len(unresolved) > 10 else ""
+        logger.warning(f"Could not find coordinates for {len(unresolved)}/{len(genes)} genes: {preview}{more}")
+        if unresolved_file:
+            with open(unresolved_file, 'w') as f:
+                f.write('\n'.join(unresolved) + '\n')
+            logger.info(f"Unresolved genes written to {unresolved_file}")
     
     # Write promoter regions to BED file
-    if promoters:
-        df = pd.DataFrame(promoters, columns=['chr', 'start', 'end', 'gene'])
+    if not df.empty:
         df.to_csv(output_file, sep='\t', index=False, header=False)
-        logger.info(f"Created promoter regions for {len(promoters)} genes")
+        logger.info(f"Created promoter regions for {len(df)} genes")
     else:
         raise Exception("No promoter regions could be created!")
 
@@ -159,9 +132,12 @@ def main():
     parser.add_argument('--downstream', type=int, default=500)
     parser.add_argument('--gtf', default="/beegfs/datasets/genomes/mm10/annotation/gencode.vM25.annotation.gtf.gz",
                       help="Path to GTF file")
+    parser.add_argument('--unresolved-output', default=None,
+                      help="Optional file to write gene names not found in the GTF")
     args = parser.parse_args()
     
-    create_promoter_regions(args.gene_list, args.output, args.upstream, args.downstream, args.gtf)
+    create_promoter_regions(args.gene_list, args.output, args.upstream, args.downstream, args.gtf,
+                            unresolved_file=args.unresolved_output)
 
 if __name__ == '__main__':
     main()
@@ -169,8 +145,8 @@ if __name__ == '__main__':
 """
 Summary:
 This script takes a list of genes and creates a BED file containing their promoter regions.
-It uses a GTF annotation file to look up the genomic coordinates and strand information
-for each gene. For genes on the + strand, the promoter is defined as a region upstream
+It looks up the genomic coordinates and strand information of all genes in one batch
+against the gene index built from the GTF annotation file and cached by scripts.gene_index. For genes on the + strand, the promoter is defined as a region upstream
 and downstream of the transcription start site (TSS). For genes on the - strand, the
 promoter is defined relative to the transcription end site (TES). The script handles
 both gzipped and uncompressed GTF files, provides detailed logging, and includes error
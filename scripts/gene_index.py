@@ -0,0 +1,250 @@
+"""
+This module builds and caches a compact gene index from a GTF annotation file.
+
+Key features:
+- Parses 'gene' features from a GTF file (gzipped or uncompressed) in a single pass
+- Uses one attribute parser for gene_name, gene_id and gene_type
+- Stores the index as a columnar binary cache (.npz) that reloads in milliseconds
+- Cache entries are keyed by the GTF's absolute path, size and modification time,
+  so an edited or replaced GTF is re-parsed automatically
+- Provides TSS region construction shared by the plotting scripts
+
+Input:
+- GTF annotation file (gzipped or uncompressed)
+- Optional cache directory (default: $AZENTA_CACHE_DIR or ~/.cache/azenta)
+
+Output:
+- pandas.DataFrame with columns:
+  chrom, start, end, strand, gene_name, gene_id, gene_type
+- Cache file in <cache_dir>/gene_index/
+"""
+
+import argparse
+import gzip
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'AZENTA_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'azenta'))
+
+GENE_INDEX_COLUMNS = ['chrom', 'start', 'end', 'strand', 'gene_name', 'gene_id', 'gene_type']
+
+# Bump when the on-disk layout changes so stale caches are ignored
+CACHE_VERSION = 1
+
+# Matches `key "value";` as well as unquoted `key value;` attribute pairs
+_ATTRIBUTE_RE = re.compile(r'\s*([^\s;]+)\s+"?([^";]*)"?\s*;?')
+
+# Indexes already loaded in this process, keyed by cache path
+_loaded_indexes = {}
+
+
+def parse_gtf_attributes(attributes):
+    """
+    Parse the attributes column (9th field) of a GTF line.
+
+    Args:
+        attributes (str): Raw attribute string, e.g. 'gene_id "X"; gene_name "Y";'
+
+    Returns:
+        dict: Mapping of attribute keys to values. For repeated keys (e.g. tag)
+              the first occurrence is kept.
+    """
+    attr_dict = {}
+    for key, value in _ATTRIBUTE_RE.findall(attributes):
+        attr_dict.setdefault(key, value)
+    return attr_dict
+
+
+def _open_gtf(gtf_file):
+    """Open a gzipped or uncompressed GTF file for text reading."""
+    if gtf_file.endswith('.gz'):
+        return gzip.open(gtf_file, 'rt')
+    return open(gtf_file)
+
+
+def build_gene_index(gtf_file):
+    """
+    Parse all 'gene' features from a GTF file.
+
+    Args:
+        gtf_file (str): Path to GTF annotation file
+
+    Returns:
+        pandas.DataFrame: Gene index with columns GENE_INDEX_COLUMNS, in file order
+    """
+    logger.info(f"Parsing gene records from {gtf_file}")
+    columns = {col: [] for col in GENE_INDEX_COLUMNS}
+
+    with _open_gtf(gtf_file) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t', 8)
+            if len(fields) < 9 or fields[2] != 'gene':
+                continue
+
+            attrs = parse_gtf_attributes(fields[8])
+            columns['chrom'].append(fields[0])
+            columns['start'].append(int(fields[3]))
+            columns['end'].append(int(fields[4]))
+            columns['strand'].append(fields[6])
+            columns['gene_name'].append(attrs.get('gene_name', ''))
+            columns['gene_id'].append(attrs.get('gene_id', ''))
+            # Older GENCODE/Ensembl releases use gene_biotype
+            columns['gene_type'].append(attrs.get('gene_type', attrs.get('gene_biotype', '')))
+
+    index = pd.DataFrame(columns, columns=GENE_INDEX_COLUMNS)
+    logger.info(f"Parsed {len(index)} genes")
+    return index
+
+
+def _cache_path(gtf_file, cache_dir):
+    """Return the cache file path for a GTF, keyed by path, size and mtime."""
+    gtf_path = os.path.abspath(gtf_file)
+    stat = os.stat(gtf_path)
+    key = f"{gtf_path}|{stat.st_size}|{stat.st_mtime_ns}|v{CACHE_VERSION}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    name = os.path.basename(gtf_path).split('.gtf')[0]
+    return os.path.join(cache_dir, 'gene_index', f"{name}.{digest}.npz")
+
+
+def _save_cache(index, path):
+    """Write the gene index to a columnar .npz file atomically."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    chrom = pd.Categorical(index['chrom'])
+    arrays = {
+        'chrom_codes': chrom.codes.astype(np.int16),
+        'chrom_names': np.asarray(chrom.categories, dtype=str),
+        'start': index['start'].to_numpy(dtype=np.int32),
+        'end': index['end'].to_numpy(dtype=np.int32),
+        'strand': index['strand'].to_numpy(dtype='U1'),
+        'gene_name': index['gene_name'].to_numpy(dtype=str),
+        'gene_id': index['gene_id'].to_numpy(dtype=str),
+        'gene_type': index['gene_type'].to_numpy(dtype=str),
+    }
+    # Write to a temporary file first so concurrent jobs never read a partial cache
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _load_cache(path):
+    """Read a gene index previously written by _save_cache."""
+    with np.load(path, allow_pickle=False) as data:
+        chrom = pd.Categorical.from_codes(data['chrom_codes'], categories=data['chrom_names'])
+        return pd.DataFrame({
+            'chrom': chrom,
+            'start': data['start'].astype(np.int64),
+            'end': data['end'].astype(np.int64),
+            'strand': data['strand'].astype(object),
+            'gene_name': data['gene_name'].astype(object),
+            'gene_id': data['gene_id'].astype(object),
+            'gene_type': data['gene_type'].astype(object),
+        }, columns=GENE_INDEX_COLUMNS)
+
+
+def load_gene_index(gtf_file, cache_dir=None, rebuild=False):
+    """
+    Load the gene index for a GTF file, parsing it only on a cache miss.
+
+    Args:
+        gtf_file (str): Path to GTF annotation file
+        cache_dir (str): Cache root directory (default: DEFAULT_CACHE_DIR)
+        rebuild (bool): Ignore any existing cache entry and re-parse the GTF
+
+    Returns:
+        pandas.DataFrame: Gene index with columns GENE_INDEX_COLUMNS
+
+    Raises:
+        FileNotFoundError: If the GTF file does not exist
+    """
+    if not os.path.exists(gtf_file):
+        raise FileNotFoundError(f"GTF file not found: {gtf_file}")
+
+    cache_path = _cache_path(gtf_file, cache_dir or DEFAULT_CACHE_DIR)
+    if not rebuild and cache_path in _loaded_indexes:
+        return _loaded_indexes[cache_path].copy()
+    if not rebuild and os.path.exists(cache_path):
+        try:
+            index = _load_cache(cache_path)
+            logger.info(f"Loaded {len(index)} genes from cache {cache_path}")
+            _loaded_indexes[cache_path] = index
+            return index.copy()
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable gene index cache {cache_path}: {str(e)}")
+
+    index = build_gene_index(gtf_file)
+    try:
+        _save_cache(index, cache_path)
+        logger.info(f"Saved gene index cache to {cache_path}")
+    except OSError as e:
+        # A read-only cache location should not stop the analysis
+        logger.warning(f"Could not write gene index cache {cache_path}: {str(e)}")
+    _loaded_indexes[cache_path] = index
+    return index.copy()
+
+
+def get_tss_regions(gtf_file, gene_list, upstream=2500, downstream=2500):
+    """
+    Build strand-aware TSS windows for the given genes.
+
+    Args:
+        gtf_file (str): Path to GTF annotation file
+        gene_list (list): Gene names to include
+        upstream (int): Base pairs upstream of the TSS
+        downstream (int): Base pairs downstream of the TSS
+
+    Returns:
+        pandas.DataFrame: Regions with columns chrom, start, end, gene_name, strand,
+                          in GTF order with a fresh 0..n-1 index
+    """
+    index = load_gene_index(gtf_file)
+    genes = index[index['gene_name'].isin(set(gene_list))]
+
+    plus = (genes['strand'] == '+').to_numpy()
+    start = genes['start'].to_numpy(dtype=np.int64)
+    end = genes['end'].to_numpy(dtype=np.int64)
+
+    return pd.DataFrame({
+        'chrom': genes['chrom'].astype(str).to_numpy(),
+        'start': np.where(plus, start - upstream, end - downstream),
+        'end': np.where(plus, start + downstream, end + upstream),
+        'gene_name': genes['gene_name'].to_numpy(),
+        'strand': genes['strand'].to_numpy(),
+    })
+
+
+def main():
+    """Parse command line arguments and build (or refresh) the gene index cache."""
+    parser = argparse.ArgumentParser(description='Build the cached gene index for a GTF file')
+    parser.add_argument('--gtf', required=True,
+                        help='Path to GTF file')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help='Cache root directory')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Re-parse the GTF even if a cache entry exists')
+    args = parser.parse_args()
+
+    index = load_gene_index(args.gtf, cache_dir=args.cache_dir, rebuild=args.rebuild)
+    logger.info(f"Genes: {len(index)}, chromosomes: {index['chrom'].nunique()}")
+    logger.info(f"Gene types:\n{index['gene_type'].value_counts().head(10)}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
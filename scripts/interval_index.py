@@ -0,0 +1,196 @@
+"""
+This module provides a per-chromosome sorted interval index for fast overlap queries.
+
+Key features:
+- Builds sorted start/end arrays per chromosome once
+- Counts overlaps for many query regions at once with binary search
+- Enumerates all overlapping (query, target) pairs without per-row Python loops
+- Finds the nearest non-overlapping target within a maximum distance
+- Supports closed (GTF-style) and half-open (BED-style) coordinates
+
+Input:
+- Target intervals as a DataFrame or arrays of chromosome, start and end
+- Query intervals as a DataFrame with the same columns
+
+Output:
+- NumPy arrays of overlap counts, (query, target) index pairs or nearest targets.
+  Target indices refer to row positions in the DataFrame the index was built from.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def build_interval_index(intervals, chrom_col='chr', start_col='start', end_col='end', closed=True):
+    """
+    Build a per-chromosome sorted interval index.
+
+    Args:
+        intervals (pandas.DataFrame): Target intervals
+        chrom_col (str): Chromosome column name
+        start_col (str): Start coordinate column name
+        end_col (str): End coordinate column name
+        closed (bool): True if intervals include both ends (GTF), False for
+                       half-open [start, end) intervals (BED)
+
+    Returns:
+        dict: {'closed': bool, 'chroms': {chrom: per-chromosome arrays}}
+    """
+    chroms = intervals[chrom_col].astype(str).to_numpy()
+    starts = intervals[start_col].to_numpy(dtype=np.int64)
+    ends = intervals[end_col].to_numpy(dtype=np.int64)
+
+    index = {'closed': closed, 'chroms': {}}
+    codes, names = pd.factorize(chroms)
+    for code, chrom in enumerate(names):
+        rows = np.flatnonzero(codes == code)
+        by_start = rows[np.argsort(starts[rows], kind='stable')]
+        by_end = rows[np.argsort(ends[rows], kind='stable')]
+        index['chroms'][chrom] = {
+            'rows_by_start': by_start,
+            'starts': starts[by_start],
+            'ends_by_start': ends[by_start],
+            'rows_by_end': by_end,
+            'ends': ends[by_end],
+            'max_length': int((ends[rows] - starts[rows]).max()),
+        }
+    return index
+
+
+def _query_arrays(regions, chrom_col, start_col, end_col):
+    """Return chromosome, start and end arrays for query regions."""
+    return (regions[chrom_col].astype(str).to_numpy(),
+            regions[start_col].to_numpy(dtype=np.int64),
+            regions[end_col].to_numpy(dtype=np.int64))
+
+
+def _iter_chroms(index, chroms):
+    """Yield (per-chromosome index, query row positions) for chromosomes present in both."""
+    codes, names = pd.factorize(chroms)
+    for code, chrom in enumerate(names):
+        if chrom in index['chroms']:
+            yield index['chroms'][chrom], np.flatnonzero(codes == code)
+
+
+def count_overlaps(index, regions, chrom_col='chr', start_col='start', end_col='end'):
+    """
+    Count target intervals overlapping each query region.
+
+    Every target ending before a query starts also starts before it, so the
+    overlap count is #(target starts <= query end) - #(target ends < query start).
+
+    Args:
+        index (dict): Index from build_interval_index
+        regions (pandas.DataFrame): Query regions
+
+    Returns:
+        numpy.ndarray: Number of overlapping targets per query row
+    """
+    chroms, starts, ends = _query_arrays(regions, chrom_col, start_col, end_col)
+    counts = np.zeros(len(regions), dtype=np.int64)
+    # Closed intervals may touch at one base; half-open ones may not
+    start_side, end_side = ('right', 'left') if index['closed'] else ('left', 'right')
+
+    for chrom_index, rows in _iter_chroms(index, chroms):
+        started = np.searchsorted(chrom_index['starts'], ends[rows], side=start_side)
+        ended = np.searchsorted(chrom_index['ends'], starts[rows], side=end_side)
+        counts[rows] = started - ended
+    return counts
+
+
+def overlap_pairs(index, regions, chrom_col='chr', start_col='start', end_col='end'):
+    """
+    Enumerate all overlapping (query, target) pairs.
+
+    Candidates are targets whose start lies within [query start - longest
+    target, query end]; candidates that end before the query are dropped.
+
+    Args:
+        index (dict): Index from build_interval_index
+        regions (pandas.DataFrame): Query regions
+
+    Returns:
+        tuple: (query row positions, target row positions, overlap lengths),
+               where overlap length is min(end) - max(start)
+    """
+    chroms, starts, ends = _query_arrays(regions, chrom_col, start_col, end_col)
+    closed = index['closed']
+    query_parts, target_parts, length_parts = [], [], []
+
+    for chrom_index, rows in _iter_chroms(index, chroms):
+        q_start, q_end = starts[rows], ends[rows]
+        lo = np.searchsorted(chrom_index['starts'], q_start - chrom_index['max_length'], side='left')
+        hi = np.searchsorted(chrom_index['starts'], q_end, side='right' if closed else 'left')
+        sizes = np.maximum(hi - lo, 0)
+        total = int(sizes.sum())
+        if total == 0:
+            continue
+
+        # Expand each query's candidate range [lo, hi) into flat position arrays
+        query_pos = np.repeat(np.arange(len(rows)), sizes)
+        offsets = np.arange(total) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        candidates = np.repeat(lo, sizes) + offsets
+
+        t_end = chrom_index['ends_by_start'][candidates]
+        hit = t_end >= q_start[query_pos] if closed else t_end > q_start[query_pos]
+        query_pos, candidates = query_pos[hit], candidates[hit]
+
+        lengths = (np.minimum(q_end[query_pos], chrom_index['ends_by_start'][candidates])
+                   - np.maximum(q_start[query_pos], chrom_index['starts'][candidates]))
+        query_parts.append(rows[query_pos])
+        target_parts.append(chrom_index['rows_by_start'][candidates])
+        length_parts.append(lengths)
+
+    if not query_parts:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty.copy(), empty.copy()
+    return np.concatenate(query_parts), np.concatenate(target_parts), np.concatenate(length_parts)
+
+
+def nearest_intervals(index, regions, max_distance, chrom_col='chr', start_col='start', end_col='end'):
+    """
+    Find the closest target on either side of each query region.
+
+    Intended for regions without an overlapping target; the distance is the
+    gap between the query and the target edge. Ties go to the upstream
+    (lower coordinate) target.
+
+    Args:
+        index (dict): Index from build_interval_index
+        regions (pandas.DataFrame): Query regions
+        max_distance (int): Maximum gap in base pairs to accept a target
+
+    Returns:
+        tuple: (target row positions, -1 where none within max_distance;
+                gap distances, -1 where none)
+    """
+    chroms, starts, ends = _query_arrays(regions, chrom_col, start_col, end_col)
+    nearest = np.full(len(regions), -1, dtype=np.int64)
+    distance = np.full(len(regions), -1, dtype=np.int64)
+    closed = index['closed']
+
+    for chrom_index, rows in _iter_chroms(index, chroms):
+        q_start, q_end = starts[rows], ends[rows]
+        n_targets = len(chrom_index['starts'])
+
+        # Upstream: the target with the largest end strictly before the query
+        left = np.searchsorted(chrom_index['ends'], q_start, side='left' if closed else 'right') - 1
+        left_ok = left >= 0
+        left_gap = np.where(left_ok, q_start - chrom_index['ends'][np.maximum(left, 0)], np.iinfo(np.int64).max)
+
+        # Downstream: the target with the smallest start strictly after the query
+        right = np.searchsorted(chrom_index['starts'], q_end, side='right' if closed else 'left')
+        right_ok = right < n_targets
+        right_gap = np.where(right_ok, chrom_index['starts'][np.minimum(right, n_targets - 1)] - q_end,
+                             np.iinfo(np.int64).max)
+
+        use_left = left_gap <= right_gap
+        gap = np.where(use_left, left_gap, right_gap)
+        target = np.where(use_left,
+                          chrom_index['rows_by_end'][np.maximum(left, 0)],
+                          chrom_index['rows_by_start'][np.minimum(right, n_targets - 1)])
+        found = (left_ok | right_ok) & (gap <= max_distance)
+
+        nearest[rows[found]] = target[found]
+        distance[rows[found]] = gap[found]
+    return nearest, distance
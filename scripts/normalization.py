@@ -0,0 +1,139 @@
+"""
+This module normalizes a samples x regions read count matrix.
+
+Key features:
+- All samples are normalized together, in memory, with array operations
+- Methods:
+  - 'cpm': counts per million mapped reads (the former per-sample RPM)
+  - 'rpkm': reads per kilobase of region per million mapped reads
+    (bigwig.normalize in config.yaml)
+  - 'median-of-ratios': DESeq2 size factors, the median ratio of each sample
+    to the per-region geometric mean over regions counted in every sample
+  - 'tmm': edgeR trimmed mean of M-values factors against a reference sample,
+    applied to CPM
+- Returns one size factor per sample, so the method and factors can be recorded
+  next to the normalized counts
+
+Input:
+- Raw counts (samples x regions), library sizes and, for RPKM, region lengths
+
+Output:
+- Normalized counts (samples x regions) and per-sample size factors, with
+  normalized = raw / size factor (and / region length in kb for RPKM)
+"""
+
+import numpy as np
+from scipy import stats
+
+NORMALIZATION_METHODS = ['cpm', 'rpkm', 'median-of-ratios', 'tmm']
+
+# Methods whose size factors are estimated from the other samples
+MULTI_SAMPLE_METHODS = ['median-of-ratios', 'tmm']
+
+
+def median_of_ratios_factors(raw_counts):
+    """
+    DESeq2 median-of-ratios size factors.
+
+    Args:
+        raw_counts (numpy.ndarray): samples x regions
+
+    Returns:
+        numpy.ndarray: Size factor per sample
+
+    Raises:
+        ValueError: If no region has reads in every sample
+    """
+    with np.errstate(divide='ignore'):
+        log_counts = np.log(raw_counts.astype(np.float64))
+    log_geo_means = log_counts.mean(axis=0)
+    usable = np.isfinite(log_geo_means)
+    if not usable.any():
+        raise ValueError("No region has reads in every sample; median-of-ratios is undefined")
+    return np.exp(np.median(log_counts[:, usable] - log_geo_means[usable], axis=1))
+
+
+def _tmm_factor(sample, reference, sample_size, reference_size, logratio_trim, sum_trim):
+    """Unscaled TMM factor of one sample against the reference (as edgeR calcNormFactors)."""
+    usable = (sample > 0) & (reference > 0)
+    sample, reference = sample[usable].astype(np.float64), reference[usable].astype(np.float64)
+    if len(sample) == 0:
+        return 1.0
+    log_sample, log_reference = np.log2(sample / sample_size), np.log2(reference / reference_size)
+    log_ratio = log_sample - log_reference
+    abundance = (log_sample + log_reference) / 2
+    variance = (sample_size - sample) / sample_size / sample + (reference_size - reference) / reference_size / reference
+
+    # Trim the extreme log ratios and abundances by rank
+    n = len(log_ratio)
+    # Ties get their average rank (R's rank()), so trimming does not depend on region order
+    ratio_rank, abundance_rank = stats.rankdata(log_ratio), stats.rankdata(abundance)
+    low_ratio, low_abundance = np.floor(n * logratio_trim) + 1, np.floor(n * sum_trim) + 1
+    keep = ((ratio_rank >= low_ratio) & (ratio_rank <= n + 1 - low_ratio)
+            & (abundance_rank >= low_abundance) & (abundance_rank <= n + 1 - low_abundance))
+    if not keep.any():
+        return 1.0
+    return float(2 ** (np.sum(log_ratio[keep] / variance[keep]) / np.sum(1 / variance[keep])))
+
+
+def tmm_factors(raw_counts, library_sizes, logratio_trim=0.3, sum_trim=0.05):
+    """
+    edgeR TMM normalization factors, scaled to a geometric mean of 1.
+
+    The reference is the sample whose upper-quartile fraction of reads is
+    closest to the mean upper quartile.
+
+    Args:
+        raw_counts (numpy.ndarray): samples x regions
+        library_sizes (numpy.ndarray): Library size per sample
+        logratio_trim (float): Fraction of log ratios trimmed at each end
+        sum_trim (float): Fraction of abundances trimmed at each end
+
+    Returns:
+        numpy.ndarray: Normalization factor per sample
+    """
+    library_sizes = np.asarray(library_sizes, dtype=np.float64)
+    upper_quartiles = np.quantile(raw_counts, 0.75, axis=1) / library_sizes
+    reference = int(np.argmin(np.abs(upper_quartiles - upper_quartiles.mean())))
+    factors = np.array([_tmm_factor(raw_counts[i], raw_counts[reference], library_sizes[i],
+                                    library_sizes[reference], logratio_trim, sum_trim)
+                        for i in range(len(raw_counts))])
+    return factors / np.exp(np.mean(np.log(factors)))
+
+
+def normalize_counts(raw_counts, library_sizes=None, method='cpm', lengths=None):
+    """
+    Normalize a samples x regions count matrix.
+
+    Args:
+        raw_counts (numpy.ndarray): samples x regions raw counts
+        library_sizes (list): Library size per sample (not used by median-of-ratios)
+        method (str): One of NORMALIZATION_METHODS
+        lengths (numpy.ndarray): Region lengths in bp (RPKM only)
+
+    Returns:
+        tuple: (normalized counts, samples x regions; size factor per sample)
+
+    Raises:
+        ValueError: For an unknown method or missing inputs
+    """
+    raw_counts = np.asarray(raw_counts)
+    if method not in NORMALIZATION_METHODS:
+        raise ValueError(f"Unknown normalization method {method}, expected one of {NORMALIZATION_METHODS}")
+    if method != 'median-of-ratios' and library_sizes is None:
+        raise ValueError(f"{method} normalization needs library sizes")
+
+    if method == 'median-of-ratios':
+        size_factors = median_of_ratios_factors(raw_counts)
+        normalized = raw_counts / size_factors[:, None]
+    else:
+        effective_sizes = np.asarray(library_sizes, dtype=np.float64)
+        if method == 'tmm':
+            effective_sizes = effective_sizes * tmm_factors(raw_counts, library_sizes)
+        normalized = raw_counts * 1e6 / effective_sizes[:, None]
+        size_factors = effective_sizes / 1e6
+    if method == 'rpkm':
+        if lengths is None:
+            raise ValueError("RPKM normalization needs region lengths")
+        normalized = normalized / (np.asarray(lengths, dtype=np.float64) / 1e3)
+    return normalized, size_factors
@@ -3,7 +3,10 @@ This script creates visualizations for comparing promoter activity between BG an
 
 Key features:
 - Creates MA plots showing fold changes vs mean expression
-- Generates peak intensity distribution plots
+- Large inputs (genome-wide peak sets) get a density MA plot: a NumPy 2D
+  histogram drawn as one rasterized image at a lower resolution, with significant
+  promoters overlaid
+- Generates peak intensity distribution plots from histogram density estimates
 - Shows chromosome-wise distribution of changes
 - Calculates and outputs summary statistics
 - Handles empty data cases with appropriate warnings
@@ -26,6 +29,8 @@ import argparse
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+from matplotlib.patches import Patch
 import seaborn as sns
 import os
 import logging
@@ -34,7 +39,90 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def visualize_promoters(comparison_file, output_dir, sample_name):
+# Above this many promoters the MA plot is drawn as a 2D histogram instead of one marker per promoter
+DENSITY_THRESHOLD = 20000
+
+# Bins per axis of the MA plot 2D histogram and of the intensity densities
+DENSITY_BINS = 200
+
+# Resolution of the MA and distribution figures in large-input mode
+DENSITY_DPI = 150
+
+def significance_mask(df):
+    """
+    Promoters highlighted as changed: |log2 FC| > 1, and padj < 0.05 where the
+    comparison file has an adjusted p-value. compare_peak_sizes.py writes NaN
+    padj for contrasts without replicates; those promoters are judged by fold
+    change alone.
+
+    Args:
+        df (pandas.DataFrame): Comparison data
+
+    Returns:
+        numpy.ndarray: Boolean mask over promoters
+    """
+    significant = np.abs(df['log2_fold_change'].to_numpy(dtype=float)) > 1
+    if 'padj' in df.columns:
+        significant &= ~(df['padj'].to_numpy(dtype=float) >= 0.05)
+    return significant
+
+def plot_ma_scatter(ax, mean_counts, fold_changes, significant):
+    """
+    Draw the MA plot with one marker per promoter, colored by direction of change.
+
+    Args:
+        ax (matplotlib.axes.Axes): Target axes
+        mean_counts (numpy.ndarray): log2 mean count per promoter
+        fold_changes (numpy.ndarray): log2 fold change per promoter
+        significant (numpy.ndarray): Boolean mask of changed promoters
+    """
+    colors = np.select([significant & (fold_changes < 0), significant & (fold_changes > 0)],
+                       ['red', 'blue'], default='gray')
+    ax.scatter(mean_counts, fold_changes, alpha=0.6, c=colors, s=50)
+
+def plot_ma_density(ax, mean_counts, fold_changes, significant, bins=DENSITY_BINS):
+    """
+    Draw the MA plot as a 2D histogram with significant promoters overlaid.
+
+    The promoters are binned once with NumPy and drawn as a single rasterized
+    image, so render time and file size depend on the number of bins rather
+    than the number of promoters.
+
+    Args:
+        ax (matplotlib.axes.Axes): Target axes
+        mean_counts (numpy.ndarray): log2 mean count per promoter
+        fold_changes (numpy.ndarray): log2 fold change per promoter
+        significant (numpy.ndarray): Boolean mask of promoters to overlay as points
+        bins (int): Bins per axis
+    """
+    finite = np.isfinite(mean_counts) & np.isfinite(fold_changes)
+    counts, x_edges, y_edges = np.histogram2d(mean_counts[finite], fold_changes[finite], bins=bins)
+    mesh = ax.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts.T, 0), cmap='Greys',
+                         norm=LogNorm(vmin=1, vmax=max(counts.max(), 1)), rasterized=True)
+    plt.colorbar(mesh, ax=ax, label='Promoters per bin')
+
+    # Overlay significant promoters on top of the density
+    for mask, color in [(significant & (fold_changes > 0), 'blue'), (significant & (fold_changes < 0), 'red')]:
+        ax.scatter(mean_counts[mask], fold_changes[mask], c=color, s=4, alpha=0.6,
+                   linewidths=0, rasterized=True)
+
+def plot_histogram_density(ax, values, edges, label, color):
+    """
+    Draw a filled histogram density estimate (replaces a KDE, which scales with
+    the number of points times the number of evaluation points).
+
+    Args:
+        ax (matplotlib.axes.Axes): Target axes
+        values (numpy.ndarray): Values to estimate the density of
+        edges (numpy.ndarray): Bin edges, shared between the compared groups
+        label (str): Legend label
+        color (str): Fill color
+    """
+    density, _ = np.histogram(values[np.isfinite(values)], bins=edges, density=True)
+    ax.stairs(density, edges, fill=True, alpha=0.3, color=color, label=label)
+    ax.stairs(density, edges, color=color)
+
+def visualize_promoters(comparison_file, output_dir, sample_name, density_threshold=DENSITY_THRESHOLD):
     """
     Create visualizations for promoter comparison between BG and BM samples.
     
@@ -42,6 +130,8 @@ def visualize_promoters(comparison_file, output_dir, sample_name):
         comparison_file (str): Path to tab-separated comparison data file
         output_dir (str): Directory to save visualization outputs
         sample_name (str): Name identifier for the sample
+        density_threshold (int): Draw the MA plot as a 2D histogram above this
+                                 many promoters
         
     Returns:
         dict: Summary statistics of the comparison
@@ -75,15 +165,21 @@ def visualize_promoters(comparison_file, output_dir, sample_name):
     
     # Create MA Plot showing relationship between mean counts and fold changes
     plt.figure(figsize=(12, 8))
-    mean_counts = (df['bg_mean'] + df['bm_mean']) / 2
-    
-    # Color-code points based on fold change thresholds
-    colors = ['red' if x < -1 else 'blue' if x > 1 else 'gray' for x in df['log2_fold_change']]
-    plt.scatter(np.log2(mean_counts + 1), df['log2_fold_change'], 
-               alpha=0.6, c=colors, s=50)
+    mean_counts = np.log2((df['bg_mean'] + df['bm_mean']).to_numpy() / 2 + 1)
+    fold_changes = df['log2_fold_change'].to_numpy(dtype=float)
+    significant = significance_mask(df)
+    uses_padj = 'padj' in df.columns and df['padj'].notna().any()
+
+    density = len(df) > density_threshold
+    if density:
+        logger.info(f"Drawing MA plot as a 2D histogram ({len(df)} promoters > {density_threshold})")
+        plot_ma_density(plt.gca(), mean_counts, fold_changes, significant)
+    else:
+        plot_ma_scatter(plt.gca(), mean_counts, fold_changes, significant)
+    dpi = DENSITY_DPI if density else 300
     
     # Process significant peaks for labeling
-    significant_peaks = df[abs(df['log2_fold_change']) > 1].copy()
+    significant_peaks = df[significant].copy()
     significant_peaks['abs_fc'] = abs(significant_peaks['log2_fold_change']).astype(float)
     
     # Identify top changed peaks in each direction
@@ -125,10 +221,11 @@ def visualize_promoters(comparison_file, output_dir, sample_name):
     plt.title('MA Plot: Mean vs Fold Change')
     
     # Add summary statistics to plot
-    up_regulated = (df['log2_fold_change'] > 1).sum()
-    down_regulated = (df['log2_fold_change'] < -1).sum()
+    up_regulated = (significant & (fold_changes > 0)).sum()
+    down_regulated = (significant & (fold_changes < 0)).sum()
+    padj_note = ', padj < 0.05' if uses_padj else ''
     plt.text(0.02, 0.98, 
-            f'Up in BM (FC > 2): {up_regulated}\nDown in BM (FC < -2): {down_regulated}', 
+            f'Up in BM (FC > 2{padj_note}): {up_regulated}\nDown in BM (FC < -2{padj_note}): {down_regulated}', 
             transform=plt.gca().transAxes, 
             verticalalignment='top',
             bbox=dict(facecolor='white', alpha=0.8))
@@ -139,21 +236,25 @@ def visualize_promoters(comparison_file, output_dir, sample_name):
                   label='Up in BM', markersize=8),
         plt.Line2D([0], [0], marker='o', color='w', markerfacecolor='red', 
                   label='Down in BM', markersize=8),
+        Patch(facecolor='gray', label='All promoters (density)') if density else
         plt.Line2D([0], [0], marker='o', color='w', markerfacecolor='gray', 
                   label='No change', markersize=8)
     ]
     plt.legend(handles=legend_elements, loc='lower right')
     
-    plt.savefig(os.path.join(sample_output_dir, f'ma_plot_{sample_name}.png'), dpi=300, bbox_inches='tight')
+    plt.savefig(os.path.join(sample_output_dir, f'ma_plot_{sample_name}.png'), dpi=dpi, bbox_inches='tight')
     plt.close()
     
     # Create distribution plots
     plt.figure(figsize=(15, 6))
     
-    # Plot peak intensity distributions
+    # Plot peak intensity distributions as histogram densities on shared bins
     plt.subplot(1, 2, 1)
-    sns.kdeplot(data=np.log2(df['bg_mean'] + 1), label='BG', color='blue', fill=True, alpha=0.3)
-    sns.kdeplot(data=np.log2(df['bm_mean'] + 1), label='BM', color='red', fill=True, alpha=0.3)
+    bg_intensity = np.log2(df['bg_mean'].to_numpy(dtype=float) + 1)
+    bm_intensity = np.log2(df['bm_mean'].to_numpy(dtype=float) + 1)
+    edges = np.histogram_bin_edges(np.concatenate([bg_intensity, bm_intensity]), bins=DENSITY_BINS)
+    plot_histogram_density(plt.gca(), bg_intensity, edges, label='BG', color='blue')
+    plot_histogram_density(plt.gca(), bm_intensity, edges, label='BM', color='red')
     plt.xlabel('log2(Peak Intensity + 1)')
     plt.ylabel('Density')
     plt.title('Distribution of Peak Intensities')
@@ -161,7 +262,8 @@ def visualize_promoters(comparison_file, output_dir, sample_name):
     
     # Plot fold change distribution
     plt.subplot(1, 2, 2)
-    sns.histplot(data=df, x='log2_fold_change', bins=50, color='purple', alpha=0.6)
+    counts, edges = np.histogram(fold_changes[np.isfinite(fold_changes)], bins=50)
+    plt.stairs(counts, edges, fill=True, color='purple', alpha=0.6)
     plt.axvline(x=0, color='black', linestyle='--', alpha=0.5)
     plt.axvline(x=1, color='blue', linestyle='--', alpha=0.3)
     plt.axvline(x=-1, color='red', linestyle='--', alpha=0.3)
@@ -170,7 +272,7 @@ def visualize_promoters(comparison_file, output_dir, sample_name):
     plt.title('Distribution of Fold Changes')
     
     plt.tight_layout()
-    plt.savefig(os.path.join(sample_output_dir, f'intensity_distributions_{sample_name}.png'), dpi=300, bbox_inches='tight')
+    plt.savefig(os.path.join(sample_output_dir, f'intensity_distributions_{sample_name}.png'), dpi=dpi, bbox_inches='tight')
     plt.close()
     
     # Create chromosome-wise distribution plots
@@ -219,13 +321,13 @@ def visualize_promoters(comparison_file, output_dir, sample_name):
     plt.savefig(os.path.join(sample_output_dir, f'chromosome_distribution_{sample_name}.png'), dpi=300, bbox_inches='tight')
     plt.close()
     
-    # Calculate summary statistics
+    # Calculate summary statistics; changed promoters use the same mask as the plots
     summary = {
         'Total promoters': len(df),
         'Mean BG intensity': df['bg_mean'].mean(),
         'Mean BM intensity': df['bm_mean'].mean(),
-        'Promoters up in BM (FC > 2)': (df['log2_fold_change'] > 1).sum(),
-        'Promoters down in BM (FC < -2)': (df['log2_fold_change'] < -1).sum(),
+        f'Promoters up in BM (FC > 2{padj_note})': up_regulated,
+        f'Promoters down in BM (FC < -2{padj_note})': down_regulated,
         'Median fold change': df['log2_fold_change'].median(),
         'Mean fold change': df['log2_fold_change'].mean(),
         'Std fold change': df['log2_fold_change'].std()
@@ -237,7 +339,7 @@ def visualize_promoters(comparison_file, output_dir, sample_name):
             f.write(f"{key}: {value:.2f}\n")
     
     # Save significantly changed promoters
-    significant_promoters = df[abs(df['log2_fold_change']) > 1].sort_values('log2_fold_change', ascending=False)
+    significant_promoters = df[significant].sort_values('log2_fold_change', ascending=False)
     significant_promoters.to_csv(os.path.join(sample_output_dir, f'significant_changes_{sample_name}.tsv'), sep='\t', index=False)
     
     logger.info("Visualization completed successfully")
@@ -252,11 +354,15 @@ def main():
                         help='Output directory for plots')
     parser.add_argument('--sample-name', required=True,
                         help='Sample name')
+    parser.add_argument('--density-threshold', type=int, default=DENSITY_THRESHOLD,
+                        help='Draw the MA plot as a 2D histogram above this many promoters '
+                             '(0 to always use the density plot)')
     
     args = parser.parse_args()
     
     try:
-        summary = visualize_promoters(args.input, args.output_dir, args.sample_name)
+        summary = visualize_promoters(args.input, args.output_dir, args.sample_name,
+                                      density_threshold=args.density_threshold)
         for key, value in summary.items():
             logger.info(f"{key}: {value:.2f}")
     except Exception as e:
@@ -275,10 +381,12 @@ differences between BG (background) and BM (treatment) samples. It generates:
 1. MA Plots:
    - Shows relationship between mean expression and fold changes
    - Highlights significantly changed promoters
+   - Switches to a 2D histogram with significant promoters overlaid for large
+     inputs, so render time stays bounded
    - Labels top changing genes
 
 2. Distribution Plots:
-   - Peak intensity distributions for both conditions
+   - Peak intensity distributions for both conditions (histogram densities)
    - Fold change distribution across all promoters
 
 3. Chromosome Analysis:
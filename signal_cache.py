@@ -0,0 +1,215 @@
+#' Persistent on-disk cache of TSS x bin signal matrices
+#'
+#' One .npy entry is stored per (bigWig, region set, bin count). Entries are keyed by:
+#' - a content fingerprint of the bigWig (size plus the first and last 64 kB, which
+#'   hold the header, total summary, zoom headers and chromosome tree)
+#' - a hash of the region coordinates and strands (this covers the window size)
+#' - the number of bins
+#' - whether the signal was read exactly or from zoom level summaries
+#' - the storage dtype
+#' Hits are memory-mapped from disk without opening the bigWig. The cache directory
+#' is kept under a size limit by evicting the least recently used entries.
+#'
+#' `load_gene_set_matrices` extracts the union of several gene lists once and
+#' builds each list's matrix by row slicing. `load_gene_set_profiles` returns
+#' mean +/- SE metaprofiles per sample group and gene list. It streams them chunk
+#' by chunk instead when the combined matrix would exceed the memory budget.
+
+import hashlib
+import os
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from scripts.gene_index import DEFAULT_CACHE_DIR, get_tss_regions
+from signal_extraction import (DEFAULT_DTYPE, EXACT_SIGNAL, MEMORY_BUDGET_BYTES, extract_signal_matrices,
+                               matrix_nbytes, moments_to_profile, profile_moments, stream_profile_stats)
+
+# Default cache size limit, overridable with AZENTA_SIGNAL_CACHE_GB
+DEFAULT_MAX_CACHE_BYTES = int(float(os.environ.get('AZENTA_SIGNAL_CACHE_GB', 20)) * 1024 ** 3)
+
+# Bump when the stored matrix layout changes so stale entries are ignored
+CACHE_VERSION = 1
+
+_FINGERPRINT_BYTES = 64 * 1024
+
+
+def bigwig_fingerprint(bw_file: str) -> str:
+    """Content fingerprint of a bigWig from its size, header and trailing index."""
+    size = os.path.getsize(bw_file)
+    digest = hashlib.sha1(str(size).encode())
+    with open(bw_file, 'rb') as f:
+        digest.update(f.read(_FINGERPRINT_BYTES))
+        f.seek(max(size - _FINGERPRINT_BYTES, 0))
+        digest.update(f.read(_FINGERPRINT_BYTES))
+    return digest.hexdigest()
+
+
+def region_set_hash(regions: pd.DataFrame) -> str:
+    """Hash of region coordinates and strands, in row order."""
+    digest = hashlib.sha1()
+    digest.update('\t'.join(regions['chrom'].astype(str)).encode())
+    digest.update(regions['start'].to_numpy(dtype=np.int64).tobytes())
+    digest.update(regions['end'].to_numpy(dtype=np.int64).tobytes())
+    digest.update(''.join(regions['strand'].astype(str)).encode())
+    return digest.hexdigest()
+
+
+def _entry_path(cache_dir: str, bw_file: str, region_hash: str, bins: int, exact: bool = True,
+                dtype=DEFAULT_DTYPE) -> str:
+    """Cache file for one bigWig / region set / bin count / extraction mode / dtype."""
+    mode = 'exact' if exact else 'zoom'
+    key = f"{bigwig_fingerprint(bw_file)}|{region_hash}|{bins}|{mode}|{np.dtype(dtype).name}|v{CACHE_VERSION}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:20]
+    name = os.path.basename(bw_file).rsplit('.', 1)[0]
+    return os.path.join(cache_dir, f"{name}.{digest}.npy")
+
+
+def prune_signal_cache(cache_dir: str, max_bytes: int = DEFAULT_MAX_CACHE_BYTES):
+    """Delete least recently used entries until the cache fits in max_bytes."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy'):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+        print(f"Evicted cached signal matrix {os.path.basename(path)}")
+
+
+def _save_entry(matrix: np.ndarray, path: str):
+    """Write one cache entry atomically."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npy.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, matrix)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_signal_matrices(bw_files: List[str], regions: pd.DataFrame, bins: int = 100,
+                         cache_dir: Optional[str] = None,
+                         max_cache_bytes: int = DEFAULT_MAX_CACHE_BYTES,
+                         exact: bool = EXACT_SIGNAL, dtype=DEFAULT_DTYPE,
+                         memory_budget: int = MEMORY_BUDGET_BYTES) -> np.ndarray:
+    """Return (files x regions x bins) signal, extracting only bigWigs missing from the cache.
+
+    Results larger than `memory_budget` are stacked into a disk-backed memmap.
+    """
+    cache_dir = cache_dir or os.path.join(DEFAULT_CACHE_DIR, 'signal_matrices')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    region_hash = region_set_hash(regions)
+    paths = [_entry_path(cache_dir, bw_file, region_hash, bins, exact, dtype) for bw_file in bw_files]
+    missing = [i for i, path in enumerate(paths) if not os.path.exists(path)]
+
+    if missing:
+        print(f"Extracting {'exact' if exact else 'approximate'} signal for {len(missing)} of "
+              f"{len(bw_files)} bigWig files ({len(regions)} regions, {bins} bins)")
+        extracted = extract_signal_matrices([bw_files[i] for i in missing], regions, bins=bins,
+                                            exact=exact, dtype=dtype, memory_budget=memory_budget)
+        for matrix, i in zip(extracted, missing):
+            _save_entry(matrix, paths[i])
+        del extracted
+    else:
+        print(f"Loaded cached signal for {len(bw_files)} bigWig files")
+
+    entries = [np.load(path, mmap_mode='r') for path in paths]
+    if matrix_nbytes(len(paths), len(regions), bins, dtype) > memory_budget:
+        print(f"Signal array exceeds the {memory_budget / 1024 ** 3:.1f} GB memory budget, "
+              f"keeping it on disk")
+        fd, stack_path = tempfile.mkstemp(dir=cache_dir, suffix='.stack.npy')
+        os.close(fd)
+        matrices = np.lib.format.open_memmap(stack_path, mode='w+', dtype=dtype,
+                                             shape=(len(paths), len(regions), bins))
+        np.stack(entries, out=matrices)
+        matrices.flush()
+        # The mapping stays valid after the file is unlinked
+        os.remove(stack_path)
+    else:
+        matrices = np.stack(entries)
+    # Mark entries as recently used for LRU eviction
+    for path in paths:
+        os.utime(path)
+    prune_signal_cache(cache_dir, max_cache_bytes)
+    return matrices
+
+
+def load_gene_set_matrices(bw_files: List[str], gene_sets: Dict[str, List[str]], gtf_file: str,
+                           bins: int = 100, upstream: int = 2500,
+                           downstream: int = 2500,
+                           exact: bool = EXACT_SIGNAL, dtype=DEFAULT_DTYPE,
+                           memory_budget: int = MEMORY_BUDGET_BYTES) -> Tuple[Dict[str, pd.DataFrame], Dict[str, np.ndarray]]:
+    """Extract signal once for the union of several gene sets, then slice per set.
+
+    Genes shared between sets (e.g. bivalent targets) are read only once. Each
+    set's regions and (files x regions x bins) matrices are identical to building
+    that set on its own.
+    """
+    union_regions, set_rows = _union_regions(gene_sets, gtf_file, upstream, downstream)
+    union_matrices = load_signal_matrices(bw_files, union_regions, bins=bins, exact=exact,
+                                          dtype=dtype, memory_budget=memory_budget)
+
+    regions, matrices = {}, {}
+    for name, rows in set_rows.items():
+        regions[name] = union_regions.iloc[rows].reset_index(drop=True)
+        matrices[name] = union_matrices[:, rows]
+    return regions, matrices
+
+
+def _union_regions(gene_sets: Dict[str, List[str]], gtf_file: str, upstream: int,
+                   downstream: int) -> Tuple[pd.DataFrame, Dict[str, np.ndarray]]:
+    """TSS regions of the union of gene sets and each set's row positions in it."""
+    all_genes = set().union(*gene_sets.values())
+    union_regions = get_tss_regions(gtf_file, list(all_genes), upstream=upstream, downstream=downstream)
+    print(f"Resolved {len(union_regions)} TSS regions for the union of {len(gene_sets)} gene sets")
+    set_rows = {name: np.flatnonzero(union_regions['gene_name'].isin(set(genes)).to_numpy())
+                for name, genes in gene_sets.items()}
+    return union_regions, set_rows
+
+
+def load_gene_set_profiles(sample_groups: Dict[str, List[str]], gene_sets: Dict[str, List[str]],
+                           gtf_file: str, bins: int = 100, upstream: int = 2500,
+                           downstream: int = 2500, exact: bool = EXACT_SIGNAL, dtype=DEFAULT_DTYPE,
+                           memory_budget: int = MEMORY_BUDGET_BYTES) -> Dict[str, Dict[str, Tuple[np.ndarray, np.ndarray]]]:
+    """Mean and standard error profiles of the replicate-averaged signal per sample group and gene set.
+
+    Returns {group: {gene set: (mean, se)}}. If the (files x regions x bins) matrix
+    for the union of the gene sets fits in `memory_budget` it is loaded through
+    the cache; otherwise each profile is streamed chunk by chunk without a matrix.
+    """
+    bw_files = [bw_file for files in sample_groups.values() for bw_file in files]
+    union_regions, set_rows = _union_regions(gene_sets, gtf_file, upstream, downstream)
+    profiles = {group: {} for group in sample_groups}
+
+    if matrix_nbytes(len(bw_files), len(union_regions), bins, dtype) > memory_budget:
+        print(f"Signal matrix exceeds the {memory_budget / 1024 ** 3:.1f} GB memory budget, "
+              f"streaming profiles")
+        for name, rows in set_rows.items():
+            regions = union_regions.iloc[rows].reset_index(drop=True)
+            for group, files in sample_groups.items():
+                profiles[group][name] = stream_profile_stats(files, regions, bins=bins, exact=exact)
+        return profiles
+
+    union_matrices = load_signal_matrices(bw_files, union_regions, bins=bins, exact=exact,
+                                          dtype=dtype, memory_budget=memory_budget)
+    offset = 0
+    for group, files in sample_groups.items():
+        group_slice = slice(offset, offset + len(files))
+        offset += len(files)
+        for name, rows in set_rows.items():
+            # Replicates are averaged with a float64 accumulator
+            averaged = np.mean(union_matrices[group_slice, rows], axis=0, dtype=np.float64)
+            profiles[group][name] = moments_to_profile(profile_moments(averaged))
+    return profiles
@@ -0,0 +1,396 @@
+#' Shared bigWig signal extraction for the TSS heatmap and metaprofile scripts
+#'
+#' Regions are read in row chunks with one `values(numpy=True)` call per region;
+#' binning (mean per bin, missing bases counted as 0), strand flipping and
+#' matrix assembly are done as whole-array operations on each chunk.
+#'
+#' `extract_signal_matrices` schedules (bigWig x chromosome-sorted chunk) tasks on
+#' a persistent worker pool; workers write their rows straight into a memory-mapped
+#' .npy output, so no matrices are pickled back to the parent process.
+#'
+#' `stream_profile_stats` builds mean +/- SE metaprofiles without materialising a
+#' matrix: each chunk is reduced to per-bin moments (count, mean, M2) in a worker
+#' and merged with the parallel Welford update.
+#'
+#' With `exact=False` (or AZENTA_SIGNAL_APPROXIMATE=1) bins are summarised from the
+#' coarsest bigWig zoom level whose resolution is at most half the bin width, as
+#' libBigWig does for `stats(exact=False)`. Zero-filled bin means are taken as
+#' zoom mean x zoom coverage. If no zoom level is fine enough the exact base-level
+#' path is used.
+#'
+#' Matrices are stored as float32 by default (`dtype`); binning and profile moments
+#' are accumulated in float64. Outputs larger than the memory budget
+#' (AZENTA_SIGNAL_MEMORY_GB, default 4) are returned as disk-backed memmaps.
+
+import atexit
+import os
+import shutil
+import struct
+import tempfile
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyBigWig
+
+# Number of regions read into one dense chunk before binning
+CHUNK_SIZE = 2048
+
+# Storage precision of signal matrices; accumulators are always float64
+DEFAULT_DTYPE = np.float32
+
+# Largest signal array held in memory, overridable with AZENTA_SIGNAL_MEMORY_GB
+MEMORY_BUDGET_BYTES = int(float(os.environ.get('AZENTA_SIGNAL_MEMORY_GB', 4)) * 1024 ** 3)
+
+# Worker pool shared by all extract_signal_matrices calls in this process
+_pool = None
+_pool_size = 0
+
+# Exact base-level extraction unless approximate zoom summaries are allowed
+EXACT_SIGNAL = os.environ.get('AZENTA_SIGNAL_APPROXIMATE', '0') != '1'
+
+# bigWig handles kept open inside each worker process
+_open_bigwigs = {}
+
+# Zoom level resolutions already read from bigWig headers
+_zoom_levels: Dict[str, List[int]] = {}
+
+
+def default_processes() -> int:
+    """Number of worker processes: the SLURM allocation if set, else usable CPUs."""
+    if os.environ.get('SLURM_CPUS_PER_TASK'):
+        return int(os.environ['SLURM_CPUS_PER_TASK'])
+    if os.environ.get('SLURM_NTASKS'):
+        return int(os.environ['SLURM_NTASKS'])
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+
+def get_worker_pool(processes: Optional[int] = None) -> Pool:
+    """Return the persistent worker pool, creating it on first use.
+
+    The pool is recreated when a different number of processes is requested.
+    """
+    global _pool, _pool_size
+    if _pool is not None and processes and processes != _pool_size:
+        close_worker_pool()
+    if _pool is None:
+        _pool_size = processes or default_processes()
+        _pool = Pool(_pool_size)
+    return _pool
+
+
+@atexit.register
+def close_worker_pool():
+    """Shut down the persistent worker pool."""
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+        _pool_size = 0
+
+
+def matrix_nbytes(n_files: int, n_regions: int, bins: int, dtype=DEFAULT_DTYPE) -> int:
+    """Size in bytes of a (files x regions x bins) signal array."""
+    return n_files * n_regions * bins * np.dtype(dtype).itemsize
+
+
+def bin_edges(width: int, bins: int) -> np.ndarray:
+    """Start offsets of each bin, splitting like np.array_split."""
+    base, extra = divmod(width, bins)
+    sizes = np.full(bins, base, dtype=np.int64)
+    sizes[:extra] += 1
+    return np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+
+def bin_rows(values: np.ndarray, bins: int) -> np.ndarray:
+    """Average each row of a (regions x bases) array into `bins` bins."""
+    width = values.shape[1]
+    if width % bins == 0:
+        return values.reshape(len(values), bins, width // bins).mean(axis=2)
+    edges = bin_edges(width, bins)
+    sizes = np.diff(np.append(edges, width))
+    return np.add.reduceat(values, edges, axis=1) / sizes
+
+
+def valid_regions(bw, regions: pd.DataFrame) -> np.ndarray:
+    """Mask of regions that lie fully inside a chromosome of the bigWig."""
+    chrom_sizes = bw.chroms()
+    lengths = regions['chrom'].map(chrom_sizes).to_numpy(dtype=float)
+    starts = regions['start'].to_numpy()
+    ends = regions['end'].to_numpy()
+    return ~np.isnan(lengths) & (starts >= 0) & (ends > starts) & (ends <= np.nan_to_num(lengths))
+
+
+def _warn_invalid(regions: pd.DataFrame, valid: np.ndarray):
+    """Print one warning listing regions that cannot be read."""
+    if not valid.all():
+        names = regions.loc[~valid, 'gene_name'].astype(str).tolist()
+        print(f"Warning: {len(names)} regions outside chromosome bounds were left empty "
+              f"({', '.join(names[:5])}{', ...' if len(names) > 5 else ''})")
+
+
+def zoom_levels(bw_file: str) -> List[int]:
+    """Resolutions (bases per zoom record) of a bigWig's zoom levels, read from its header."""
+    if bw_file not in _zoom_levels:
+        with open(bw_file, 'rb') as f:
+            header = f.read(64)
+            _, _, n_zoom = struct.unpack_from('<IHH', header)
+            zoom_headers = f.read(24 * n_zoom)
+        _zoom_levels[bw_file] = sorted(struct.unpack_from('<I', zoom_headers, 24 * i)[0]
+                                       for i in range(n_zoom))
+    return _zoom_levels[bw_file]
+
+
+def zoom_resolution(bw_file: str, bin_width: int) -> Optional[int]:
+    """Coarsest zoom resolution usable for bins of `bin_width` bases, or None if none fits."""
+    fitting = [level for level in zoom_levels(bw_file) if level <= bin_width // 2]
+    return fitting[-1] if fitting else None
+
+
+def use_zoom_levels(bw_file: str, widths: np.ndarray, bins: int, exact: bool) -> bool:
+    """Decide whether a bigWig can be read from its zoom levels, and report the choice."""
+    if exact or len(widths) == 0:
+        return False
+    bin_width = int(widths.min()) // bins
+    resolution = zoom_resolution(bw_file, bin_width)
+    if resolution is None:
+        print(f"No zoom level of {os.path.basename(bw_file)} fits {bin_width} bp bins, "
+              f"reading base-level data")
+        return False
+    print(f"Reading {os.path.basename(bw_file)} from the {resolution} bp zoom level "
+          f"for {bin_width} bp bins")
+    return True
+
+
+def _zoom_rows(bw, chroms: np.ndarray, starts: np.ndarray, width: int, bins: int) -> np.ndarray:
+    """Approximate zero-filled bin means of equal-width regions from zoom summaries."""
+    binned = np.empty((len(chroms), bins))
+    for j, (chrom, start) in enumerate(zip(chroms, starts)):
+        start = int(start)
+        mean = bw.stats(chrom, start, start + width, type='mean', nBins=bins, exact=False)
+        coverage = bw.stats(chrom, start, start + width, type='coverage', nBins=bins, exact=False)
+        # None marks bins without data
+        binned[j] = np.array(mean, dtype=float) * np.array(coverage, dtype=float)
+    return np.nan_to_num(binned, copy=False)
+
+
+def _extract_rows(bw, chroms: np.ndarray, starts: np.ndarray, widths: np.ndarray,
+                  minus: np.ndarray, bins: int, zoom: bool = False) -> np.ndarray:
+    """Binned, strand-oriented signal for a chunk of valid regions."""
+    matrix = np.zeros((len(chroms), bins))
+    # Regions of equal width (the usual TSS window) are binned together
+    for width in np.unique(widths):
+        if width < bins:
+            continue
+        rows = np.flatnonzero(widths == width)
+        if zoom:
+            matrix[rows] = _zoom_rows(bw, chroms[rows], starts[rows], int(width), bins)
+            continue
+        dense = np.empty((len(rows), width))
+        for j, row in enumerate(rows):
+            start = int(starts[row])
+            dense[j] = bw.values(chroms[row], start, start + int(width), numpy=True)
+        # Bases without data count as zero signal
+        np.nan_to_num(dense, copy=False)
+        matrix[rows] = bin_rows(dense, bins)
+
+    # Reverse the signal for all negative strand regions at once
+    matrix[minus] = matrix[minus, ::-1]
+    return matrix
+
+
+def extract_signal(bw_file: str, regions: pd.DataFrame, bins: int = 100,
+                   exact: bool = EXACT_SIGNAL, dtype=DEFAULT_DTYPE) -> np.ndarray:
+    """Extract signal from bigWig file for given regions."""
+    matrix = np.zeros((len(regions), bins), dtype=dtype)
+    if len(regions) == 0:
+        return matrix
+
+    chroms = regions['chrom'].to_numpy()
+    starts = regions['start'].to_numpy(dtype=np.int64)
+    widths = regions['end'].to_numpy(dtype=np.int64) - starts
+    minus = (regions['strand'] == '-').to_numpy()
+
+    with pyBigWig.open(bw_file) as bw:
+        valid = valid_regions(bw, regions)
+        _warn_invalid(regions, valid)
+        rows = np.flatnonzero(valid)
+        zoom = use_zoom_levels(bw_file, widths[rows], bins, exact)
+        for chunk_start in range(0, len(rows), CHUNK_SIZE):
+            chunk = rows[chunk_start:chunk_start + CHUNK_SIZE]
+            matrix[chunk] = _extract_rows(bw, chroms[chunk], starts[chunk], widths[chunk],
+                                          minus[chunk], bins, zoom)
+    return matrix
+
+
+def _extract_chunk_task(task: tuple) -> int:
+    """Worker: extract one (bigWig, region chunk) task into the shared output."""
+    out_path, file_index, bw_file, rows, chroms, starts, widths, minus, bins, zoom = task
+    if bw_file not in _open_bigwigs:
+        _open_bigwigs[bw_file] = pyBigWig.open(bw_file)
+    matrix = _extract_rows(_open_bigwigs[bw_file], chroms, starts, widths, minus, bins, zoom)
+
+    out = np.load(out_path, mmap_mode='r+')
+    out[file_index, rows] = matrix
+    out.flush()
+    del out
+    return len(rows)
+
+
+def extract_signal_matrices(bw_files: List[str], regions: pd.DataFrame, bins: int = 100,
+                            processes: Optional[int] = None, chunk_size: int = CHUNK_SIZE,
+                            out_path: Optional[str] = None,
+                            exact: bool = EXACT_SIGNAL, dtype=DEFAULT_DTYPE,
+                            memory_budget: int = MEMORY_BUDGET_BYTES) -> np.ndarray:
+    """Extract a (files x regions x bins) signal array with the persistent worker pool.
+
+    Regions are sorted by chromosome and start, split into chunks, and every
+    (file, chunk) pair becomes one task. Workers write into a memory-mapped .npy
+    file; if `out_path` is given that file is kept and returned as a read-only
+    memmap. Otherwise the result is loaded into memory, or, if it is larger than
+    `memory_budget`, returned as a memmap of the (already unlinked) temporary file.
+    With `exact=False` each bigWig is read from its coarsest fitting zoom level.
+    """
+    n_files, n_regions = len(bw_files), len(regions)
+    chroms = regions['chrom'].astype(str).to_numpy()
+    starts = regions['start'].to_numpy(dtype=np.int64)
+    widths = regions['end'].to_numpy(dtype=np.int64) - starts
+    minus = (regions['strand'] == '-').to_numpy()
+
+    # Regions outside the genome are left as zeros; bigWigs of one project share chromosomes
+    with pyBigWig.open(bw_files[0]) as bw:
+        valid = valid_regions(bw, regions)
+    _warn_invalid(regions, valid)
+
+    # Chromosome-sorted chunks keep each task's reads local in the bigWig index
+    rows = np.flatnonzero(valid)
+    rows = rows[np.lexsort((starts[rows], chroms[rows]))]
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+
+    tmp_dir = None
+    if out_path is None:
+        tmp_dir = tempfile.mkdtemp(prefix='signal_')
+        target = os.path.join(tmp_dir, 'matrices.npy')
+    else:
+        target = out_path
+    out = np.lib.format.open_memmap(target, mode='w+', dtype=dtype,
+                                    shape=(n_files, n_regions, bins))
+    out.flush()
+    del out
+
+    zoom = [use_zoom_levels(bw_file, widths[rows], bins, exact) for bw_file in bw_files]
+    tasks = [(target, i, bw_file, chunk, chroms[chunk], starts[chunk], widths[chunk], minus[chunk],
+              bins, zoom[i])
+             for i, bw_file in enumerate(bw_files) for chunk in chunks]
+    try:
+        processes = min(processes or default_processes(), max(len(tasks), 1))
+        if processes <= 1:
+            for task in tasks:
+                _extract_chunk_task(task)
+            for bw in _open_bigwigs.values():
+                bw.close()
+            _open_bigwigs.clear()
+        else:
+            for _ in get_worker_pool(processes).imap_unordered(_extract_chunk_task, tasks):
+                pass
+
+        if out_path is not None:
+            return np.load(out_path, mmap_mode='r')
+        if matrix_nbytes(n_files, n_regions, bins, dtype) > memory_budget:
+            print(f"Signal array exceeds the {memory_budget / 1024 ** 3:.1f} GB memory budget, "
+                  f"keeping it on disk")
+            # The mapping stays valid after the temporary directory is removed
+            return np.load(target, mmap_mode='r')
+        return np.load(target)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def profile_moments(matrix: np.ndarray) -> Tuple[int, np.ndarray, np.ndarray]:
+    """Per-bin count, mean and sum of squared deviations of a (regions x bins) matrix."""
+    matrix = np.asarray(matrix, dtype=np.float64)
+    mean = matrix.mean(axis=0)
+    return len(matrix), mean, ((matrix - mean) ** 2).sum(axis=0)
+
+
+def merge_profile_moments(a: Tuple[int, np.ndarray, np.ndarray],
+                          b: Tuple[int, np.ndarray, np.ndarray]) -> Tuple[int, np.ndarray, np.ndarray]:
+    """Combine the moments of two disjoint region sets (Chan et al. parallel update)."""
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    if n_a == 0:
+        return b
+    if n_b == 0:
+        return a
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n
+
+
+def moments_to_profile(moments: Tuple[int, np.ndarray, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Mean and standard error profile (population SD / sqrt(n)) from merged moments."""
+    n, mean, m2 = moments
+    n = max(n, 1)
+    return mean, np.sqrt(m2 / n) / np.sqrt(n)
+
+
+def _profile_chunk_task(task: tuple) -> Tuple[int, np.ndarray, np.ndarray]:
+    """Worker: moments of the file-averaged signal for one region chunk."""
+    bw_files, zoom, valid, chroms, starts, widths, minus, bins = task
+    averaged = np.zeros((len(valid), bins))
+    rows = np.flatnonzero(valid)
+    for bw_file, file_zoom in zip(bw_files, zoom):
+        if bw_file not in _open_bigwigs:
+            _open_bigwigs[bw_file] = pyBigWig.open(bw_file)
+        averaged[rows] += _extract_rows(_open_bigwigs[bw_file], chroms[rows], starts[rows],
+                                        widths[rows], minus[rows], bins, file_zoom)
+    averaged /= len(bw_files)
+    return profile_moments(averaged)
+
+
+def stream_profile_stats(bw_files: List[str], regions: pd.DataFrame, bins: int = 100,
+                         processes: Optional[int] = None,
+                         chunk_size: int = CHUNK_SIZE,
+                         exact: bool = EXACT_SIGNAL) -> Tuple[np.ndarray, np.ndarray]:
+    """Mean and standard error profile of the replicate-averaged signal, computed in chunks.
+
+    Matches the mean and SE (population SD / sqrt(n)) over regions of
+    np.mean([extract_signal(f, regions) for f in bw_files], axis=0)
+    while holding at most one chunk x bins array per file in each worker.
+    """
+    chroms = regions['chrom'].astype(str).to_numpy()
+    starts = regions['start'].to_numpy(dtype=np.int64)
+    widths = regions['end'].to_numpy(dtype=np.int64) - starts
+    minus = (regions['strand'] == '-').to_numpy()
+
+    with pyBigWig.open(bw_files[0]) as bw:
+        valid = valid_regions(bw, regions)
+    _warn_invalid(regions, valid)
+
+    zoom = [use_zoom_levels(bw_file, widths[valid], bins, exact) for bw_file in bw_files]
+
+    # Invalid regions stay in as zero rows, as in the matrix-based profiles
+    order = np.lexsort((starts, chroms))
+    tasks = []
+    for i in range(0, len(order), chunk_size):
+        chunk = order[i:i + chunk_size]
+        tasks.append((list(bw_files), zoom, valid[chunk], chroms[chunk], starts[chunk],
+                      widths[chunk], minus[chunk], bins))
+
+    moments = (0, np.zeros(bins), np.zeros(bins))
+    processes = min(processes or default_processes(), max(len(tasks), 1))
+    if processes <= 1:
+        results = map(_profile_chunk_task, tasks)
+    else:
+        results = get_worker_pool(processes).imap_unordered(_profile_chunk_task, tasks)
+    for chunk_moments in results:
+        moments = merge_profile_moments(moments, chunk_moments)
+    if processes <= 1:
+        for bw in _open_bigwigs.values():
+            bw.close()
+        _open_bigwigs.clear()
+
+    return moments_to_profile(moments)
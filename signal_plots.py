@@ -0,0 +1,307 @@
+#' Shared TSS heatmap and metaprofile plotting
+#'
+#' Figures are declared as dicts and rendered by `render_figures` from a single
+#' load of the signal matrices, so one process can draw any number of figures
+#' without re-reading the GTF or the bigWigs.
+#'
+#' Heatmap figure:
+#'   {'kind': 'heatmap', 'output': 'path.pdf', 'title': 'SMARCB1 Signal at TSS',
+#'    'scale': 18.0,                # fixed vmax, or ('percentile', 99) shared across panels
+#'    'show_n': False,              # append (n=...) to panel titles
+#'    'panels': [{'gene_set': 'targeted', 'group': 'bm', 'title': 'Targeted Genes'}, ...]}
+#'
+#' Metaprofile figure:
+#'   {'kind': 'profile', 'output': 'path.pdf', 'title': 'SMARCB1 binding around TSS',
+#'    'lines': [{'gene_set': 'up', 'group': 'bm', 'label': 'Up regulated - BM',
+#'               'linestyle': '-', 'alpha': 0.2}, ...],
+#'    'fold_change': {'numerator': 'bm', 'denominator': 'bg'}}   # optional log2 ratio panel
+#'
+#' `gene_set` names refer to the gene list files and `group` names to the sample
+#' groups passed to `render_figures`; groups with several bigWigs are averaged.
+#'
+#' With more than one process, figures are drawn in parallel by a pool of Agg
+#' workers. The heatmap matrices are written once to .npy files that each worker
+#' memory-maps, so no matrix is pickled to the workers.
+#'
+#' `draw_heatmap` renders a (regions x bins) matrix with `imshow` as one
+#' rasterized image layer, so PDF size and render time do not grow with the
+#' number of regions. Matrices with more rows than the axes has pixels at the
+#' output dpi are first averaged in consecutive row blocks. The axes keep the
+#' sns.heatmap layout: bin coordinates on x, first region at the top and a
+#' colorbar to the right.
+
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+from signal_cache import load_gene_set_matrices, load_gene_set_profiles
+from signal_extraction import bin_edges, default_processes, moments_to_profile, profile_moments
+
+# Line colors of the regulated gene categories
+PROFILE_COLORS = {
+    'up': '#ff7f0e',
+    'down': '#2ca02c',
+    'not': '#1f77b4'
+}
+
+
+def load_gene_list(file_path: str) -> List[str]:
+    """Load gene list from CSV file."""
+    return pd.read_csv(file_path, header=None)[0].tolist()
+
+
+def aggregate_rows(matrix: np.ndarray, n_rows: int) -> np.ndarray:
+    """Average consecutive row blocks of a matrix down to at most n_rows rows."""
+    if len(matrix) <= n_rows:
+        return matrix
+    edges = bin_edges(len(matrix), n_rows)
+    sizes = np.diff(np.append(edges, len(matrix)))
+    return np.add.reduceat(np.asarray(matrix, dtype=np.float64), edges, axis=0) / sizes[:, None]
+
+
+def axes_pixel_rows(ax, dpi: float = 300) -> int:
+    """Height of an axes in pixels when the figure is saved at dpi."""
+    return max(int(ax.get_position().height * ax.figure.get_figheight() * dpi), 1)
+
+
+def draw_heatmap(data: np.ndarray, ax, cmap: str = 'YlOrRd', vmin: Optional[float] = None,
+                 vmax: Optional[float] = None, max_rows: Optional[int] = None, dpi: float = 300):
+    """Draw a rasterized heatmap of a (regions x bins) matrix on ax.
+
+    max_rows defaults to the pixel height of ax at dpi; pass 0 to draw every row.
+    """
+    n_rows, n_bins = data.shape
+    if max_rows is None:
+        max_rows = axes_pixel_rows(ax, dpi)
+    image = aggregate_rows(data, max_rows) if max_rows else data
+
+    # Extent in row/bin units keeps tick positions identical to sns.heatmap
+    mesh = ax.imshow(image, cmap=cmap, vmin=vmin, vmax=vmax, aspect='auto',
+                     interpolation='nearest', extent=(0, n_bins, n_rows, 0), rasterized=True)
+    colorbar = ax.figure.colorbar(mesh, ax=ax)
+    colorbar.outline.set_linewidth(0)
+    ax.set_yticks([])
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    return mesh
+
+
+def heatmap_vmax(matrices: List[np.ndarray], scale) -> float:
+    """Shared color scale maximum: a fixed value or ('percentile', q) over all panels."""
+    if isinstance(scale, tuple):
+        _, q = scale
+        return max(np.percentile(matrix, q) for matrix in matrices)
+    return float(scale)
+
+
+def _tss_labels(upstream: int, downstream: int) -> List[str]:
+    """Tick labels for the window start, TSS and window end."""
+    return [f'-{upstream / 1000:g}kb', 'TSS', f'+{downstream / 1000:g}kb']
+
+
+def plot_heatmap_figure(figure: Dict, matrices: Dict[Tuple[str, str], np.ndarray],
+                        upstream: int = 2500, downstream: int = 2500):
+    """Create and save one row of heatmaps sharing a color scale."""
+    panels = figure['panels']
+    fig, axes = plt.subplots(1, len(panels), figsize=figure.get('figsize', (6 * len(panels), 6)))
+    axes = np.atleast_1d(axes)
+    fig.suptitle(figure['title'], fontsize=16)
+
+    panel_data = [matrices[(panel['group'], panel['gene_set'])] for panel in panels]
+    vmax = heatmap_vmax(panel_data, figure.get('scale', 18.0))
+
+    for ax, panel, data in zip(axes, panels, panel_data):
+        draw_heatmap(data, ax, cmap=figure.get('cmap', 'YlOrRd'), vmax=vmax)
+        title = panel['title']
+        if figure.get('show_n', False):
+            title = f"{title}\n(n={len(data)})"
+        ax.set_title(title)
+        ax.set_xlabel('Distance from TSS')
+
+        # Add custom x-axis labels at proper positions
+        num_bins = data.shape[1]
+        ax.set_xticks([0, num_bins//2, num_bins])
+        ax.set_xticklabels(_tss_labels(upstream, downstream))
+
+    plt.tight_layout()
+    plt.savefig(figure['output'], dpi=300, bbox_inches='tight')
+    plt.close()
+
+
+def plot_profile_figure(figure: Dict, profiles: Dict[Tuple[str, str], Tuple[np.ndarray, np.ndarray]],
+                        upstream: int = 2500, downstream: int = 2500):
+    """Create and save a metaprofile plot, optionally with a log2 fold change panel."""
+    fold_change = figure.get('fold_change')
+    if fold_change:
+        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=figure.get('figsize', (10, 12)), height_ratios=[2, 1])
+    else:
+        fig, ax1 = plt.subplots(figsize=figure.get('figsize', (10, 6)))
+
+    lines = figure['lines']
+    n_bins = profiles[(lines[0]['group'], lines[0]['gene_set'])][0].shape[0]
+    x_pos = np.linspace(-upstream, downstream, n_bins)
+
+    for line in lines:
+        mean_profile, se_profile = profiles[(line['group'], line['gene_set'])]
+        color = PROFILE_COLORS.get(line['gene_set'])
+        ax1.plot(x_pos, mean_profile, color=color, linestyle=line.get('linestyle', '-'),
+                 label=line['label'])
+        ax1.fill_between(x_pos, mean_profile - se_profile, mean_profile + se_profile,
+                         color=color, alpha=line.get('alpha', 0.2))
+
+    ax1.set_title(figure['title'])
+    ax1.set_xlabel('Distance from TSS (bp)')
+    ax1.set_ylabel(figure.get('ylabel', 'Average RPKM'))
+    ax1.legend()
+
+    if fold_change:
+        numerator, denominator = fold_change['numerator'], fold_change['denominator']
+        for gene_set in dict.fromkeys(line['gene_set'] for line in lines):
+            ratio = np.log2(profiles[(numerator, gene_set)][0] / profiles[(denominator, gene_set)][0])
+            ax2.plot(x_pos, ratio, color=PROFILE_COLORS.get(gene_set),
+                     label=f'{gene_set.capitalize()} regulated')
+        ax2.set_title(f'Log2 Fold Change ({numerator.upper()}/{denominator.upper()})')
+        ax2.set_xlabel('Distance from TSS (bp)')
+        ax2.set_ylabel('Log2 Fold Change')
+        ax2.axhline(y=0, color='gray', linestyle='--', alpha=0.5)
+        ax2.legend()
+
+    plt.tight_layout()
+    plt.savefig(figure['output'], dpi=300, bbox_inches='tight')
+    plt.close()
+
+
+def _print_profile_summary(profiles: Dict[Tuple[str, str], Tuple[np.ndarray, np.ndarray]],
+                           gene_sets: Dict[str, List[str]], figures: List[Dict]):
+    """Print gene counts and mean signal per gene set and sample group.
+
+    Gene sets shown in a fold change panel also get the log2 ratio of the mean signals.
+    """
+    fold_changes = {}
+    for figure in figures:
+        if figure.get('fold_change'):
+            ratio = (figure['fold_change']['numerator'], figure['fold_change']['denominator'])
+            for line in figure['lines']:
+                fold_changes.setdefault(line['gene_set'], {})[ratio] = None
+
+    for gene_set in dict.fromkeys(name for _, name in profiles):
+        print(f"\nSummary Statistics for {gene_set} genes:")
+        print(f"Number of genes: {len(gene_sets[gene_set])}")
+        for (group, name), (mean_profile, _) in profiles.items():
+            # The mean profile averages equal-sized bins, so its mean is the matrix mean
+            if name == gene_set:
+                print(f"Mean {group.upper()} signal: {np.mean(mean_profile):.3f}")
+        ratios = fold_changes.get(gene_set, {})
+        for numerator, denominator in ratios:
+            label = f" ({numerator.upper()}/{denominator.upper()})" if len(ratios) > 1 else ""
+            fold_change = np.log2(np.mean(profiles[(numerator, gene_set)][0]) /
+                                  np.mean(profiles[(denominator, gene_set)][0]))
+            print(f"Mean log2 fold change{label}: {fold_change:.3f}\n")
+
+
+def _init_render_worker():
+    """Use the non-interactive Agg backend in rendering workers."""
+    plt.switch_backend('Agg')
+
+
+def _render_figure_task(task: tuple) -> str:
+    """Worker: draw one figure from memory-mapped matrices."""
+    figure, matrix_paths, profiles, upstream, downstream = task
+    if figure['kind'] == 'heatmap':
+        matrices = {key: np.load(matrix_paths[key], mmap_mode='r')
+                    for key in ((panel['group'], panel['gene_set']) for panel in figure['panels'])}
+        plot_heatmap_figure(figure, matrices, upstream, downstream)
+    else:
+        plot_profile_figure(figure, profiles, upstream, downstream)
+    return figure['output']
+
+
+def draw_figures(figures: List[Dict], matrices: Dict[Tuple[str, str], np.ndarray],
+                 profiles: Dict[Tuple[str, str], Tuple[np.ndarray, np.ndarray]],
+                 upstream: int = 2500, downstream: int = 2500, processes: Optional[int] = None):
+    """Draw figures from loaded matrices and profiles, in parallel when several processes are available."""
+    processes = min(processes or default_processes(), len(figures))
+    if processes <= 1:
+        for figure in figures:
+            print(f"Generating {figure['output']}...")
+            if figure['kind'] == 'heatmap':
+                plot_heatmap_figure(figure, matrices, upstream, downstream)
+            else:
+                plot_profile_figure(figure, profiles, upstream, downstream)
+        return
+
+    tmp_dir = tempfile.mkdtemp(prefix='figures_')
+    try:
+        # Only heatmap panels read matrices in the workers
+        used = dict.fromkeys((panel['group'], panel['gene_set'])
+                             for figure in figures for panel in figure.get('panels', []))
+        matrix_paths = {}
+        for i, key in enumerate(used):
+            matrix_paths[key] = os.path.join(tmp_dir, f"matrix_{i}.npy")
+            np.save(matrix_paths[key], matrices[key])
+
+        tasks = [(figure, matrix_paths, profiles, upstream, downstream) for figure in figures]
+        print(f"Rendering {len(figures)} figures with {processes} processes...")
+        with Pool(processes, initializer=_init_render_worker) as pool:
+            for output in pool.imap_unordered(_render_figure_task, tasks):
+                print(f"Generated {output}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def render_figures(figures: List[Dict], sample_groups: Dict[str, List[str]],
+                   gene_files: Dict[str, str], gtf_file: str, upstream: int = 2500,
+                   downstream: int = 2500, bins: int = 100, processes: Optional[int] = None):
+    """Load signal once for every gene set and sample group used by figures, then draw them all.
+
+    Heatmaps need full matrices, which also yield the profiles. When only
+    metaprofiles are requested they are computed with load_gene_set_profiles,
+    which streams them if the matrices would exceed the memory budget.
+    """
+    used = set()
+    for figure in figures:
+        for item in figure.get('panels', []) + figure.get('lines', []):
+            used.add((item['group'], item['gene_set']))
+        if figure.get('fold_change'):
+            for line in figure['lines']:
+                used.add((figure['fold_change']['numerator'], line['gene_set']))
+                used.add((figure['fold_change']['denominator'], line['gene_set']))
+
+    groups = {group: sample_groups[group] for group in sample_groups if any(g == group for g, _ in used)}
+    print("Loading gene lists...")
+    gene_sets = {name: load_gene_list(gene_files[name])
+                 for name in gene_files if any(s == name for _, s in used)}
+
+    print("Processing bigWig files...")
+    matrices, profiles = {}, {}
+    if any(figure['kind'] == 'heatmap' for figure in figures):
+        bw_files = [bw_file for files in groups.values() for bw_file in files]
+        _, set_matrices = load_gene_set_matrices(bw_files, gene_sets, gtf_file, bins=bins,
+                                                 upstream=upstream, downstream=downstream)
+        offset = 0
+        for group, files in groups.items():
+            for name, matrix in set_matrices.items():
+                if len(files) == 1:
+                    matrices[(group, name)] = matrix[offset]
+                else:
+                    # Replicates are averaged with a float64 accumulator
+                    matrices[(group, name)] = np.mean(matrix[offset:offset + len(files)], axis=0,
+                                                      dtype=np.float64)
+                profiles[(group, name)] = moments_to_profile(profile_moments(matrices[(group, name)]))
+            offset += len(files)
+    else:
+        group_profiles = load_gene_set_profiles(groups, gene_sets, gtf_file, bins=bins,
+                                                upstream=upstream, downstream=downstream)
+        profiles = {(group, name): profile for group, by_set in group_profiles.items()
+                    for name, profile in by_set.items()}
+
+    if any(figure['kind'] == 'profile' for figure in figures):
+        _print_profile_summary(profiles, gene_sets, figures)
+
+    draw_figures(figures, matrices, profiles, upstream, downstream, processes)
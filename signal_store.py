@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+#' Dense per-chromosome signal store expanded from bigWig files
+#'
+#' Each bigWig is decompressed once into one memory-mapped .npy array per
+#' chromosome, holding the zero-filled mean signal of consecutive `resolution` bp
+#' bins (default 10 bp, the `bigwig.bin_size` in config.yaml). Queries are then
+#' served without touching the bigWig:
+#' - `store_window` returns a zero-copy slice of a chromosome array
+#' - `store_signal_matrix` builds a (regions x bins) TSS matrix with one fancy
+#'   indexing operation per chromosome
+#' Window coordinates are snapped down to the store resolution, so matrices agree
+#' with `extract_signal` up to the resolution of the store.
+#'
+#' Usage:
+#'   python signal_store.py results/bigwig/BG1_CPM.bw results/bigwig/BM3_CPM.bw
+#'   python signal_store.py --resolution 10 --dtype float16 results/bigwig/*.bw
+#'
+#' Stores are written to $AZENTA_CACHE_DIR/signal_store/<bigWig>.<fingerprint>.<resolution>bp.<dtype>/
+#' and are rebuilt automatically when the bigWig changes.
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyBigWig
+
+from scripts.gene_index import DEFAULT_CACHE_DIR
+from signal_cache import bigwig_fingerprint
+from signal_extraction import bin_rows
+
+# bigwig.bin_size in config.yaml
+DEFAULT_RESOLUTION = 10
+
+# Bases decompressed per values() call while converting
+_READ_BLOCK = 10_000_000
+
+# Stores already opened in this process, keyed by store directory
+_open_stores = {}
+
+
+def signal_store_path(bw_file: str, resolution: int = DEFAULT_RESOLUTION, dtype: str = 'float32',
+                      store_dir: Optional[str] = None) -> str:
+    """Directory of the store for one bigWig, resolution and dtype."""
+    store_dir = store_dir or os.path.join(DEFAULT_CACHE_DIR, 'signal_store')
+    name = os.path.basename(bw_file).rsplit('.', 1)[0]
+    digest = bigwig_fingerprint(bw_file)[:20]
+    return os.path.join(store_dir, f"{name}.{digest}.{resolution}bp.{np.dtype(dtype).name}")
+
+
+def _convert_chromosome(bw, chrom: str, length: int, resolution: int, path: str, dtype: str):
+    """Write the binned signal of one chromosome to a .npy file."""
+    n_bins = -(-length // resolution)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n_bins,))
+    block = _READ_BLOCK - _READ_BLOCK % resolution
+    for start in range(0, length, block):
+        end = min(start + block, length)
+        values = np.nan_to_num(bw.values(chrom, start, end, numpy=True), copy=False)
+        # Pad the last partial bin with zeros, as missing bases count as zero signal
+        padded = np.zeros(-(-len(values) // resolution) * resolution)
+        padded[:len(values)] = values
+        out[start // resolution:start // resolution + len(padded) // resolution] = \
+            padded.reshape(-1, resolution).mean(axis=1)
+    out.flush()
+    del out
+
+
+def build_signal_store(bw_file: str, resolution: int = DEFAULT_RESOLUTION, dtype: str = 'float32',
+                       store_dir: Optional[str] = None, rebuild: bool = False) -> str:
+    """Expand a bigWig into per-chromosome binned arrays and return the store directory."""
+    path = signal_store_path(bw_file, resolution, dtype, store_dir)
+    if os.path.exists(path) and not rebuild:
+        print(f"Signal store for {os.path.basename(bw_file)} already exists: {path}")
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Build in a temporary directory so readers never see a partial store
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.tmp_')
+    try:
+        with pyBigWig.open(bw_file) as bw:
+            chrom_sizes = bw.chroms()
+            for chrom, length in chrom_sizes.items():
+                print(f"Converting {os.path.basename(bw_file)} {chrom} ({length} bp)")
+                _convert_chromosome(bw, chrom, length, resolution,
+                                    os.path.join(tmp_path, f"{chrom}.npy"), dtype)
+        with open(os.path.join(tmp_path, 'store.json'), 'w') as f:
+            json.dump({'bigwig': os.path.abspath(bw_file), 'resolution': resolution,
+                       'dtype': np.dtype(dtype).name, 'chroms': chrom_sizes}, f, indent=2)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    print(f"Saved signal store to {path}")
+    return path
+
+
+def open_signal_store(path: str) -> Dict:
+    """Open a store as {'resolution', 'chrom_sizes', 'chroms': {chrom: read-only memmap}}."""
+    if path not in _open_stores:
+        with open(os.path.join(path, 'store.json')) as f:
+            meta = json.load(f)
+        _open_stores[path] = {
+            'resolution': meta['resolution'],
+            'chrom_sizes': meta['chroms'],
+            'chroms': {chrom: np.load(os.path.join(path, f"{chrom}.npy"), mmap_mode='r')
+                       for chrom in meta['chroms']},
+        }
+    return _open_stores[path]
+
+
+def store_window(store: Dict, chrom: str, start: int, end: int) -> np.ndarray:
+    """Zero-copy view of the binned signal covering [start, end)."""
+    resolution = store['resolution']
+    return store['chroms'][chrom][start // resolution:-(-end // resolution)]
+
+
+def store_signal_matrix(store: Dict, regions: pd.DataFrame, bins: int = 100) -> np.ndarray:
+    """Binned, strand-oriented (regions x bins) signal, as extract_signal, read from a store."""
+    resolution = store['resolution']
+    matrix = np.zeros((len(regions), bins))
+    if len(regions) == 0:
+        return matrix
+
+    chroms = regions['chrom'].astype(str).to_numpy()
+    first = regions['start'].to_numpy(dtype=np.int64) // resolution
+    n_cols = regions['end'].to_numpy(dtype=np.int64) // resolution - first
+    lengths = regions['chrom'].map(store['chrom_sizes']).to_numpy(dtype=float)
+    valid = (~np.isnan(lengths) & (first >= 0) & (n_cols >= bins)
+             & (first + n_cols <= -(-np.nan_to_num(lengths).astype(np.int64) // resolution)))
+    if not valid.all():
+        print(f"Warning: {int((~valid).sum())} regions outside chromosome bounds were left empty")
+
+    codes, names = pd.factorize(chroms)
+    for code, chrom in enumerate(names):
+        chrom_rows = np.flatnonzero((codes == code) & valid)
+        # Regions of equal width are gathered with one fancy index per chromosome
+        for width in np.unique(n_cols[chrom_rows]):
+            rows = chrom_rows[n_cols[chrom_rows] == width]
+            columns = first[rows, None] + np.arange(width)
+            matrix[rows] = bin_rows(store['chroms'][chrom][columns].astype(np.float64), bins)
+
+    minus = (regions['strand'] == '-').to_numpy()
+    matrix[minus] = matrix[minus, ::-1]
+    return matrix
+
+
+def store_signal_matrices(bw_files: List[str], regions: pd.DataFrame, bins: int = 100,
+                          resolution: int = DEFAULT_RESOLUTION, dtype: str = 'float32',
+                          store_dir: Optional[str] = None) -> np.ndarray:
+    """(files x regions x bins) signal served from the stores, converting missing bigWigs first."""
+    stores = [open_signal_store(build_signal_store(bw_file, resolution, dtype, store_dir))
+              for bw_file in bw_files]
+    return np.stack([store_signal_matrix(store, regions, bins) for store in stores])
+
+
+def main():
+    """Convert bigWig files into dense signal stores."""
+    parser = argparse.ArgumentParser(description='Expand bigWig files into memory-mapped per-chromosome arrays')
+    parser.add_argument('bigwigs', nargs='+',
+                        help='bigWig files to convert')
+    parser.add_argument('--resolution', type=int, default=DEFAULT_RESOLUTION,
+                        help=f'Bin size in bp (default: {DEFAULT_RESOLUTION}, bigwig.bin_size in config.yaml)')
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default='float32',
+                        help='Storage precision (default: float32)')
+    parser.add_argument('--store-dir', default=None,
+                        help='Store root directory (default: $AZENTA_CACHE_DIR/signal_store)')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Convert again even if a store exists')
+    args = parser.parse_args()
+
+    for bw_file in args.bigwigs:
+        build_signal_store(bw_file, args.resolution, args.dtype, args.store_dir, args.rebuild)
+
+
+if __name__ == '__main__':
+    main()
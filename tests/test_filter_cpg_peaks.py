@@ -0,0 +1,45 @@
+"""Tests for scripts/filter_cpg_peaks.py."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+from filter_cpg_peaks import filter_cpg_peaks, read_bed  # noqa: E402
+
+
+def write_lines(path, lines):
+    path.write_text(''.join(line + '\n' for line in lines))
+    return str(path)
+
+
+def test_read_bed_skips_track_browser_and_comment_lines(tmp_path):
+    bed_file = write_lines(tmp_path / 'peaks.bed', [
+        'track name=peaks description="test peaks"',
+        'browser position chr1:1-1000',
+        '# comment',
+        'chr1\t100\t200\tpeak1',
+        'chr2\t300\t400\tpeak2',
+    ])
+    bed = read_bed(bed_file)
+    assert bed['chr'].tolist() == ['chr1', 'chr2']
+    assert bed['start'].tolist() == [100, 300]
+    assert bed['end'].tolist() == [200, 400]
+    assert bed[3].tolist() == ['peak1', 'peak2']
+
+
+def test_filter_cpg_peaks_with_track_lines(tmp_path):
+    peaks_file = write_lines(tmp_path / 'peaks.bed', [
+        'track name=peaks',
+        'chr1\t100\t200\tinside',
+        'chr1\t200\t300\tadjacent',
+        'chr2\t100\t200\tother_chrom',
+    ])
+    cpg_file = write_lines(tmp_path / 'cpg.bed', [
+        'track name=cpg',
+        'chr1\t150\t200',
+    ])
+    output_file = str(tmp_path / 'out' / 'filtered.bed')
+    assert filter_cpg_peaks(peaks_file, cpg_file, output_file) == (3, 1)
+    with open(output_file) as f:
+        assert f.read() == 'chr1\t100\t200\tinside\n'